@@ -1,18 +1,778 @@
+import atexit
 import csv
-import tkinter as tk
-from tkinter import messagebox
+import errno
+import heapq
+import json
+import math
+import mmap
+import os
+import queue
+import re
+import sqlite3
+import struct
+import sys
+import threading
+from array import array
+from collections import deque
+from bisect import bisect_left, insort
+from contextlib import contextmanager
+from itertools import chain, compress, count, islice, tee
+
+from history import MileageHistory
+from instrumentation import OperationStats, instrumented
+
+try:
+    import fcntl
+except ImportError:  # Windows; msvcrt.locking is used instead
+    fcntl = None
+try:
+    import msvcrt
+except ImportError:
+    msvcrt = None
+
+FIELDNAMES = ['id', 'name','type', 'details', 'mileage', 'kart_id']
+# Journal entries: op ('put', 'del' or 'add'), the row, and for 'add' the
+# mileage added (row['mileage'] is then the total it came to). Compaction
+# adds 'compacted' entries, see CarPartDatabase.replay_journal.
+JOURNAL_FIELDS = ['op'] + FIELDNAMES + ['delta']
+
+# Binary snapshot: header, string table (offsets + UTF-8 blob), then one
+# fixed-width column per field. Strings are stored as string table indexes.
+# Every section starts on an 8 byte boundary so it can be cast in place.
+# The header also has the mtime, size and inode of the CSV the snapshot was
+# made from; the snapshot is only used while the CSV still matches exactly.
+SNAPSHOT_MAGIC = b'KARTSNP3'
+SNAPSHOT_HEADER = struct.Struct('<8s6IqQQ')  # magic, byte order, strings, parts, karts, tracks, intervals, CSV mtime_ns, size, inode
+
+class Part:
+    # Parts are by far the most numerous records, so they get a compact
+    # typed record instead of a dict. Item access is kept so the rest of
+    # the code (and csv.DictWriter) can keep treating them like rows.
+    __slots__ = ('id', 'name', 'details', 'mileage', 'kart_id')
+    type = 'part'
+
+    def __init__(self, id, name, details='', mileage=0.0, kart_id='0'):
+        self.id = str(id)
+        self.name = sys.intern(name)
+        self.details = details
+        self.mileage = float(mileage or 0)
+        self.kart_id = sys.intern(str(kart_id))
+
+    @classmethod
+    def from_row(cls, row):
+        return cls(row['id'], row['name'], row.get('details') or '', row['mileage'], row['kart_id'])
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key) from None
 
-class CarPartDatabase:
+    def __setitem__(self, key, value):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+    def keys(self):
+        return FIELDNAMES
+
+    def copy(self):
+        return Part(self.id, self.name, self.details, self.mileage, self.kart_id)
+
+    def __repr__(self):
+        return f"Part({self.id!r}, {self.name!r}, mileage={self.mileage!r}, kart_id={self.kart_id!r})"
+
+class SqliteBackend:
+    # Same rows as the CSV, one table keyed on (type, id)
     def __init__(self, filename):
+        self.conn = sqlite3.connect(filename, check_same_thread=False)  # writes may come from BackgroundWriter
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        with self.conn:
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS records ('
+                'id TEXT NOT NULL, name TEXT, type TEXT NOT NULL, details TEXT, '
+                'mileage REAL, kart_id TEXT, PRIMARY KEY (type, id))')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS records_kart_id ON records (kart_id, type)')
+
+    def rows(self):
+        cursor = self.conn.execute('SELECT id, name, type, details, mileage, kart_id FROM records ORDER BY rowid')
+        for values in cursor:
+            yield dict(zip(FIELDNAMES, values))
+
+    def version(self):
+        # Changes when another connection commits, not when this one does
+        return self.conn.execute('PRAGMA data_version').fetchone()[0]
+
+    def write(self, changes):
+        with self.conn:  # one transaction per commit
+            for op, row in changes:
+                if op == 'put':
+                    # Kart and part mileage only changes through 'add' (which
+                    # other instances' additions survive), so a put leaves an
+                    # existing row's mileage alone
+                    self.conn.execute(
+                        'INSERT INTO records (id, name, type, details, mileage, kart_id) '
+                        'VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT (type, id) DO UPDATE SET '
+                        'name = excluded.name, details = excluded.details, kart_id = excluded.kart_id, '
+                        "mileage = CASE WHEN type IN ('kart', 'part') THEN mileage ELSE excluded.mileage END",
+                        (str(row['id']), row['name'], row['type'], row.get('details', ''), row['mileage'], str(row['kart_id'])))
+                elif op == 'del':
+                    self.conn.execute('DELETE FROM records WHERE type = ? AND id = ?', (row['type'], str(row['id'])))
+                elif op == 'add':
+                    self.conn.execute(
+                        'UPDATE records SET mileage = mileage + ? WHERE type = ? AND id = ?',
+                        (row['delta'], row['type'], str(row['id'])))
+                elif op == 'add_mileage':
+                    self.conn.execute(
+                        'UPDATE records SET mileage = mileage + ? WHERE type = ? AND kart_id = ?',
+                        (row['mileage'], row['type'], str(row['kart_id'])))
+
+    def save(self, db):
+        with self.conn:
+            self.conn.execute('DELETE FROM records')
+        self.write([('put', row) for row in db.all_rows()])
+
+    def close(self):
+        self.conn.close()
+
+BACKENDS = {'sqlite': SqliteBackend}
+
+def split_words(text):
+    return re.findall(r'\w+', text.lower())
+
+def unique(items):
+    seen = set()
+    for item in items:
+        if item not in seen:
+            seen.add(item)
+            yield item
+
+class SearchIndex:
+    # Words of each part's name and details. words is kept sorted, so every
+    # word starting with a prefix is in one slice of it.
+    def __init__(self, parts=()):
+        self.postings = {}  # word -> ids of the parts using it, in insertion order
+        self.part_words = {}
+        for part in parts:
+            self.index(part)
+        self.words = sorted(self.postings)
+
+    def index(self, part):
+        new = []
+        words = set(split_words(part.name + ' ' + part.details))
+        self.part_words[part.id] = words
+        for word in words:
+            ids = self.postings.get(word)
+            if ids is None:
+                ids = self.postings[word] = {}
+                new.append(word)
+            ids[part.id] = None
+        return new
+
+    def add(self, part):
+        for word in self.index(part):
+            insort(self.words, word)
+
+    def discard(self, part_id):
+        for word in self.part_words.pop(part_id, ()):
+            ids = self.postings[word]
+            del ids[part_id]
+            if not ids:
+                del self.postings[word]
+                del self.words[bisect_left(self.words, word)]
+
+    def with_prefix(self, prefix):
+        start = bisect_left(self.words, prefix)
+        end = bisect_left(self.words, prefix[:-1] + chr(ord(prefix[-1]) + 1))
+        return self.words[start:end]
+
+    def matches(self, part_id, terms):
+        words = self.part_words.get(part_id, ())
+        return all(any(word.startswith(term) for word in words) for term in terms)
+
+    def search(self, query, offset=0, limit=100):
+        # Every term in the query has to start some word of the part. Walks
+        # the postings of the rarest term and stops once the page is full,
+        # so the cost depends on offset + limit rather than on the fleet.
+        terms = split_words(query)
+        if not terms:
+            return [], False
+        matched = [self.with_prefix(term) for term in terms]
+        sizes = [sum(len(self.postings[word]) for word in words) for words in matched]
+        rarest = sizes.index(min(sizes))
+        if len(matched[rarest]) == 1:
+            candidates = iter(self.postings[matched[rarest][0]])
+        else:
+            candidates = unique(chain.from_iterable(self.postings[word] for word in matched[rarest]))
+        # The other terms are checked without a Python call per part
+        for i, words in enumerate(matched):
+            if i == rarest:
+                continue
+            if len(words) == 1:
+                candidates = filter(self.postings[words[0]].__contains__, candidates)
+            else:
+                words = set(words)
+                candidates, probe = tee(candidates)
+                candidates = compress(candidates, map(words.intersection, map(self.part_words.__getitem__, probe)))
+        found = list(islice(candidates, offset, offset + limit + 1))
+        return found[:limit], len(found) > limit
+
+class FleetTotals:
+    # Sums over the parts kept up to date as parts change, so dashboards
+    # never loop over every part. Every update is O(1).
+    def __init__(self):
+        self.kart_mileage = {}  # kart_id -> mileage of the parts on it
+        self.part_types = {}  # part name -> [parts, mileage]
+
+    def add(self, part):
+        self.kart_mileage[part.kart_id] = self.kart_mileage.get(part.kart_id, 0.0) + part.mileage
+        totals = self.part_types.get(part.name)
+        if totals is None:
+            self.part_types[part.name] = [1, part.mileage]
+        else:
+            totals[0] += 1
+            totals[1] += part.mileage
+
+    def discard(self, part):
+        self.kart_mileage[part.kart_id] -= part.mileage
+        totals = self.part_types[part.name]
+        totals[0] -= 1
+        totals[1] -= part.mileage
+        if not totals[0]:
+            del self.part_types[part.name]
+
+    def add_mileage(self, part, mileage):
+        self.kart_mileage[part.kart_id] += mileage
+        self.part_types[part.name][1] += mileage
+
+class ServiceSchedule:
+    # Min-heap of (remaining mileage, part id). Entries are never removed in
+    # place: pushing a newer value for a part makes its older entries stale,
+    # and stale entries are dropped when they surface or on a rebuild.
+    def __init__(self):
+        self.heap = []
+        self.remaining = {}
+
+    def update(self, part_id, remaining):
+        self.remaining[part_id] = remaining
+        heapq.heappush(self.heap, (remaining, part_id))
+        if len(self.heap) > 2 * len(self.remaining) + 64:
+            self.rebuild()
+
+    def discard(self, part_id):
+        self.remaining.pop(part_id, None)
+
+    def rebuild(self):
+        self.heap = [(remaining, part_id) for part_id, remaining in self.remaining.items()]
+        heapq.heapify(self.heap)
+
+    def next_due(self, count, limit=None):
+        # The count parts with the least mileage left, optionally only those
+        # with at most limit left; costs O(count log n)
+        found = []
+        while self.heap and len(found) < count:
+            remaining, part_id = self.heap[0]
+            if limit is not None and remaining > limit:
+                break
+            heapq.heappop(self.heap)
+            if self.remaining.get(part_id) == remaining and (remaining, part_id) not in found:
+                found.append((remaining, part_id))
+        for entry in found:
+            heapq.heappush(self.heap, entry)
+        return found
+
+class BackgroundWriter:
+    # Runs a database's writes on their own thread. Commits that arrive
+    # while a write is in progress are merged into the next one. Errors are
+    # put on self.errors for the GUI thread to pick up.
+    def __init__(self, db):
+        self.db = db
+        self.errors = queue.Queue()
+        self.queue = []
+        self.events = []  # history events, written with the changes
+        self.busy = False
+        self.closed = False
+        self.cond = threading.Condition()
+        self.thread = threading.Thread(target=self.run, name='car-parts-writer', daemon=True)
+        self.thread.start()
+
+    def submit(self, changes, events=()):
+        # Rows are copied now; the records keep changing on the caller's thread
+        changes = [copy_change(op, row) for op, row in changes]
+        with self.cond:
+            self.queue.extend(changes)
+            self.events.extend(events)
+            self.cond.notify_all()
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.queue and not self.events and not self.closed:
+                    self.cond.wait()
+                if not self.queue and not self.events:
+                    return
+                changes, self.queue = self.queue, []
+                events, self.events = self.events, []
+                self.busy = True
+            try:
+                self.db.persist(changes, events)
+            except Exception as error:
+                self.errors.put(error)
+            finally:
+                with self.cond:
+                    self.busy = False
+                    self.cond.notify_all()
+
+    def idle(self):
+        with self.cond:
+            return not (self.queue or self.events or self.busy)
+
+    def flush(self):
+        with self.cond:
+            while self.queue or self.events or self.busy:
+                self.cond.wait()
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        self.thread.join()
+
+class FileLock:
+    # Advisory lock on <database>.lock, held while the database files are
+    # read or written so another instance never sees half a write.
+    # Re-entrant, and shared by every instance in the process, since a
+    # second flock on the same file from one process would block on itself.
+    locks = {}
+    guard = threading.Lock()
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = threading.RLock()
+        self.depth = 0
+        self.file = None
+
+    @classmethod
+    def for_file(cls, filename):
+        with cls.guard:
+            key = os.path.abspath(filename)
+            if key not in cls.locks:
+                cls.locks[key] = cls(filename)
+            return cls.locks[key]
+
+    def __enter__(self):
+        self.lock.acquire()
+        if self.depth == 0 and (fcntl or msvcrt):
+            try:
+                self.file = open(self.filename, 'a')
+                lock_file(self.file)
+            except FileNotFoundError:
+                pass  # no directory, so no files to share; the write itself will fail
+            except BaseException:
+                if self.file:
+                    self.file.close()
+                    self.file = None
+                self.lock.release()
+                raise
+        self.depth += 1
+        return self
+
+    def __exit__(self, *exc_info):
+        self.depth -= 1
+        if self.depth == 0 and self.file:
+            unlock_file(self.file)
+            self.file.close()
+            self.file = None
+        self.lock.release()
+
+def lock_file(file):
+    if fcntl:
+        fcntl.flock(file, fcntl.LOCK_EX)
+        return
+    # msvcrt locks bytes from the current position; byte 0 is the lock
+    file.seek(0)
+    while True:
+        try:
+            msvcrt.locking(file.fileno(), msvcrt.LK_LOCK, 1)
+            return
+        except OSError as error:
+            if error.errno != errno.EDEADLOCK:
+                raise
+            # LK_LOCK gives up after about 10 seconds; flock would keep waiting
+
+def unlock_file(file):
+    if fcntl:
+        fcntl.flock(file, fcntl.LOCK_UN)
+    else:
+        file.seek(0)
+        msvcrt.locking(file.fileno(), msvcrt.LK_UNLCK, 1)
+
+def file_signature(filename):
+    # Enough to tell that another process has rewritten or appended to a file
+    try:
+        stat = os.stat(filename)
+    except FileNotFoundError:
+        return None
+    return (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+
+def align(offset):
+    return (offset + 7) & ~7
+
+def record_values(row):
+    return tuple(str(row.get(field, '')) for field in FIELDNAMES)
+
+def settle(mileage, logged):
+    # Adding the same deltas in a different grouping can differ in the last
+    # bits; when the sum is the logged total, the logged total is kept exactly
+    return logged if math.isclose(mileage, logged, rel_tol=1e-12, abs_tol=1e-9) else mileage
+
+def copy_change(op, row):
+    if op == 'add_mileage':
+        return op, dict(row, parts=[dict(part) for part in row['parts']])
+    return op, dict(row)
+
+class CarPartDatabase:
+    def __init__(self, filename, journal=False, compact_threshold=1000, backend=None, background=False,
+                 slow_threshold=None, snapshot=False, service_margin=0.0, history=False, undo_limit=100):
+        self.stats = OperationStats(slow_threshold=slow_threshold)
         self.filename = filename
+        self.snapshot_filename = filename + '.snap' if snapshot else None
+        self.backend_name = backend
+        self.backend = BACKENDS[backend](filename) if backend else None
+        self.file_lock = FileLock.for_file(filename + '.lock')
+        self.ids_filename = filename + '.ids'
+        self.ids_lock = FileLock.for_file(filename + '.ids.lock')  # not file_lock, which writes hold for a while
+        self.journal = journal
+        self.journal_filename = filename + '.journal'
+        self.compact_threshold = compact_threshold
+        self.journal_size = 0
+        self.batch_depth = 0
+        self.pending = {}
+        self.pending_ids = count()
+        self.listeners = []
+        self.write_lock = threading.RLock()
+        self.writer = None
         self.karts = {}
-        self.parts = []
+        self.parts_by_id = {}  # in insertion order, which is the CSV's
+        self.parts = self.parts_by_id.values()
+        self.kart_parts = {}  # kart_id -> ids of the parts on it, in insertion order
         self.tracks = {}
+        self.intervals = {}  # 'part:<id>' or 'type:<part name>' -> service interval
+        self.schedule = ServiceSchedule()
+        self.search_index = None  # built by the first search, then kept up to date
+        self.totals = FleetTotals()
+        self.track_totals = {}  # track_id -> [mileage, laps] driven there
+        self.history = MileageHistory(filename + '.history') if history else None
+        self.service_margin = service_margin
+        self.alerts = []
+        # Undo entries are (label, steps), each step an (undo, redo) pair of
+        # ('put', row) / ('del', row) / ('mileage', kart_id, part_ids,
+        # sessions, sign) operations. Only the touched records are kept, so
+        # an entry's size does not grow with the fleet.
+        self.undo_log = deque(maxlen=undo_limit)
+        self.redo_log = deque(maxlen=undo_limit)
+        self.undo_group = None  # steps of the batch in progress
+        self.seen_state = None  # file_state() as of our last read or write
+        self.journal_offset = 0  # bytes of the journal already applied
+        self.own_appends = []  # (start, end) of journal entries we wrote while behind
+        self.writes = 0  # counts our writes to the files, see apply_file_changes
         self.load_data()
+        if background:
+            self.writer = BackgroundWriter(self)
+            atexit.register(self.close)
 
+    def close(self):
+        # Waits for queued writes; safe to call more than once
+        if self.writer:
+            self.writer.close()
+            self.writer = None
+
+    def flush(self):
+        if self.writer:
+            self.writer.flush()
+
+    @instrumented
     def load_data(self):
+        with self.file_lock:
+            if self.backend:
+                for row in self.backend.rows():
+                    self.apply_row(row)
+            else:
+                if not self.read_snapshot():
+                    self.read_csv(self.filename)
+                    if self.snapshot_filename and os.path.exists(self.filename):
+                        self.write_snapshot()
+                if self.journal:
+                    self.replay_journal()
+            self.note_files()
+        self.reschedule()
+        self.alerts = []  # only crossings from here on are reported
+        if self.history:
+            # Track totals are only kept in the history; rebuilt from its rollups
+            for (type, track_id), (hours, mileage, laps, after) in self.history.rollups.items():
+                if type == 'track':
+                    self.track_totals[track_id] = [sum(mileage), sum(laps)]
+
+    def file_state(self):
+        if self.backend:
+            return self.backend.version()
+        return (file_signature(self.filename), file_signature(self.journal_filename) if self.journal else None)
+
+    def files_current(self):
+        return self.file_state() == self.seen_state
+
+    def note_files(self, state=None):
+        # Called with the file lock held, after reading the files or after
+        # writing to them while we were up to date; or with the state the
+        # files were read in
+        self.seen_state = self.file_state() if state is None else state
+        if self.journal and not self.backend:
+            self.journal_offset = self.seen_state[1][1] if self.seen_state[1] else 0
+            self.own_appends = []
+
+    def read_files(self):
+        # A separate copy of what is on disk, to compare or merge against
+        other = CarPartDatabase(self.filename, journal=self.journal, backend=self.backend_name, undo_limit=0)
+        if other.backend:
+            other.backend.close()  # everything was read by load_data
+        return other
+
+    def check_for_changes(self):
+        # Picks up what other instances (another PC on the same synced
+        # files) wrote since we last read or wrote the files. Only records
+        # that differ are applied, and listeners are told about just those.
+        # Split in two so the GUI can read the files on another thread:
+        # read_file_changes does the reading, apply_file_changes the rest.
+        return self.apply_file_changes(self.read_file_changes())
+
+    def ready_for_file_changes(self):
+        # Not in a batch, and none of our writes queued or in progress;
+        # checks never wait for those, the next one picks the changes up
+        return not self.batch_depth and (self.writer is None or self.writer.idle())
+
+    @instrumented
+    def read_file_changes(self):
+        # Safe to call from any thread; returns what apply_file_changes
+        # needs, or None when there is nothing to apply
+        if not self.ready_for_file_changes():
+            return None
+        with self.file_lock:
+            writes = self.writes
+            state = self.file_state()
+            if state == self.seen_state:
+                return None
+            if self.backend:
+                return writes, state, self.read_files(), None
+            if state[0] is None and state[1] is None:
+                return None  # files gone (mid-sync?); keep what we have
+            if self.journal and self.journal_grew(state):
+                with open(self.journal_filename, 'rb') as file:
+                    file.seek(self.journal_offset)
+                    data = file.read(state[1][1] - self.journal_offset)
+                return writes, state, None, data
+            return writes, state, self.read_files(), None
+
+    @instrumented
+    def apply_file_changes(self, read):
+        # On the thread that owns the records. A read from before one of our
+        # own writes, or with writes queued, no longer matches what we have
+        # and is dropped; the next check reads again.
+        if read is None or read[0] != self.writes or not self.ready_for_file_changes():
+            return []
+        writes, state, other, data = read
+        with self.write_lock:
+            if other is not None:
+                changes = self.merge_files(other)
+            else:
+                changes = self.read_journal_tail(data)
+            self.note_files(state)
+        if changes:
+            self.notify(changes)
+        return changes
+
+    def journal_grew(self, state):
+        # Only appends since we last looked: the CSV is the same file and so
+        # is the journal, just longer
+        csv_state, journal_state = state
+        seen_csv, seen_journal = self.seen_state
+        if csv_state != seen_csv or journal_state is None:
+            return False
+        if seen_journal is not None and seen_journal[2] != journal_state[2]:
+            return False
+        return journal_state[1] >= self.journal_offset
+
+    def read_journal_tail(self, data):
+        # data is the journal from journal_offset on
+        position = self.journal_offset
+
+        def lines():
+            nonlocal position
+            for line in data.splitlines(keepends=True):
+                position += len(line)
+                yield line.decode('utf-8')
+
+        # Entries we appended while behind are applied again in file order,
+        # so other instances' earlier entries don't win over ours, except
+        # 'add': it is relative and already in our records
+        changes = []
+        start = position
+        for row in csv.DictReader(lines(), fieldnames=JOURNAL_FIELDS):
+            ours = any(begin <= start < end for begin, end in self.own_appends)
+            start = position
+            self.journal_size += 1
+            op = row.pop('op')
+            if op == 'compacted' or ours and op == 'add':
+                continue
+            self.apply_entry(op, row)
+            changes.append((op, row))
+        return changes
+
+    def merge_files(self, other):
+        # The files were replaced (another instance saved or compacted), so
+        # they were read whole (other), but only the records that differ
+        # from ours are applied
+        ours = {(row['type'], str(row['id'])): row for row in self.all_rows()}
+        changes = []
+        for row in other.all_rows():
+            key = (row['type'], str(row['id']))
+            current = ours.pop(key, None)
+            if current is None or record_values(current) != record_values(row):
+                self.apply_row(row)
+                changes.append(('put', row))
+        for type, id in ours:
+            row = {'id': id, 'type': type}
+            self.delete_row(row)
+            changes.append(('del', row))
+        self.journal_size = other.journal_size
+        return changes
+
+    @instrumented
+    def read_snapshot(self):
+        # Returns False (and loads nothing) when the snapshot is missing,
+        # was made from a different CSV or is unreadable. Comparing times
+        # alone is not enough: a sync tool can bring in a CSV with an older
+        # mtime, and coarse mtimes hide quick edits.
+        if not self.snapshot_filename or not os.path.exists(self.snapshot_filename):
+            return False
+        with open(self.snapshot_filename, 'rb') as file:
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                # Checked before any view of data exists, as the mmap cannot
+                # be closed while one does
+                try:
+                    (magic, byteorder, strings, parts, karts, tracks, intervals,
+                     csv_mtime, csv_size, csv_inode) = SNAPSHOT_HEADER.unpack_from(data)
+                except struct.error:
+                    return False
+                if magic != SNAPSHOT_MAGIC or byteorder != (sys.byteorder == 'little'):
+                    return False
+                if (csv_mtime, csv_size, csv_inode) != file_signature(self.filename):
+                    return False
+                view = memoryview(data)
+                try:
+                    offset = align(SNAPSHOT_HEADER.size)
+
+                    def column(code, length):
+                        nonlocal offset
+                        size = length * array(code).itemsize
+                        values = view[offset:offset + size].cast(code)
+                        offset = align(offset + size)
+                        return values
+
+                    bounds = column('Q', strings + 1)
+                    blob = view[offset:offset + bounds[-1]]
+                    offset = align(offset + bounds[-1])
+                    table = [str(blob[bounds[i]:bounds[i + 1]], 'utf-8') for i in range(strings)]
+                    part_columns = [column('I', parts) for _ in range(4)] + [column('d', parts)]
+                    kart_columns = [column('I', karts) for _ in range(3)] + [column('d', karts)]
+                    track_columns = [column('I', tracks) for _ in range(3)]
+                    interval_columns = [column('I', intervals), column('d', intervals)]
+                    del blob
+                except (struct.error, ValueError, TypeError, IndexError):
+                    return False
+                ids, names, details, kart_ids, mileages = part_columns
+                for i in range(parts):
+                    self.insert_part(Part(table[ids[i]], table[names[i]], table[details[i]], mileages[i], table[kart_ids[i]]))
+                ids, names, kart_ids, mileages = kart_columns
+                for i in range(karts):
+                    self.karts[table[ids[i]]] = {
+                        'name': table[names[i]],
+                        'type': 'kart',
+                        'mileage': mileages[i],
+                        'kart_id': table[kart_ids[i]]
+                    }
+                ids, names, lengths = track_columns
+                for i in range(tracks):
+                    self.tracks[table[ids[i]]] = {
+                        'name': table[names[i]],
+                        'type': 'track',
+                        'mileage': table[lengths[i]]
+                    }
+                keys, limits = interval_columns
+                for i in range(intervals):
+                    self.intervals[table[keys[i]]] = limits[i]
+                for values in part_columns + kart_columns + track_columns + interval_columns + [bounds]:
+                    values.release()
+                view.release()
+        return True
+
+    @instrumented
+    def write_snapshot(self):
+        # Called right after the CSV was read or written, with the file lock held
+        csv_signature = file_signature(self.filename)
+        if csv_signature is None:
+            return
+        parts = list(self.parts)
+        karts = list(self.karts.items())
+        tracks = list(self.tracks.items())
+        intervals = list(self.intervals.items())
+        table = {}
+
+        def index(value):
+            value = str(value)
+            position = table.get(value)
+            if position is None:
+                position = table[value] = len(table)
+            return position
+
+        part_columns = [array('I', [index(part.id) for part in parts]),
+                        array('I', [index(part.name) for part in parts]),
+                        array('I', [index(part.details) for part in parts]),
+                        array('I', [index(part.kart_id) for part in parts]),
+                        array('d', [part.mileage for part in parts])]
+        kart_columns = [array('I', [index(kart_id) for kart_id, kart_data in karts]),
+                        array('I', [index(kart_data['name']) for kart_id, kart_data in karts]),
+                        array('I', [index(kart_data['kart_id']) for kart_id, kart_data in karts]),
+                        array('d', [float(kart_data['mileage']) for kart_id, kart_data in karts])]
+        track_columns = [array('I', [index(id) for id, track_data in tracks]),
+                         array('I', [index(track_data['name']) for id, track_data in tracks]),
+                         array('I', [index(track_data['mileage']) for id, track_data in tracks])]
+        interval_columns = [array('I', [index(key) for key, limit in intervals]),
+                            array('d', [limit for key, limit in intervals])]
+        encoded = [value.encode('utf-8') for value in table]
+        bounds = array('Q', [0])
+        for value in encoded:
+            bounds.append(bounds[-1] + len(value))
+
+        temp_filename = self.snapshot_filename + '.tmp'
+        with open(temp_filename, 'wb') as file:
+            file.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, sys.byteorder == 'little', len(table),
+                                            len(parts), len(karts), len(tracks), len(intervals), *csv_signature))
+            for section in [bounds, b''.join(encoded)] + part_columns + kart_columns + track_columns + interval_columns:
+                file.write(b'\0' * (align(file.tell()) - file.tell()))
+                file.write(section.tobytes() if isinstance(section, array) else section)
+            file.flush()
+            os.fsync(file.fileno())
+            self.stats.add_bytes(file.tell())
+        os.replace(temp_filename, self.snapshot_filename)
+
+    @instrumented
+    def read_csv(self, filename):
         try:
-            with open(self.filename, 'r', newline="") as file:
+            with open(filename, 'r', newline="") as file:
                 reader = csv.DictReader(file)
                 for row in reader:
                     if row['type']=='kart':
@@ -30,15 +790,7 @@ class CarPartDatabase:
                         #kart_parts = self.karts[kart_id]['parts']
                         #kart_parts[row['id']] = {'name': row['name'], 'mileage': row['mileage']}
                     elif row['type']=='part':
-                        part_details = row.get('details', '')  # Handle missing details field
-                        self.parts.append({
-                            'id': row['id'],
-                            'name': row['name'],
-                            'type': 'part',
-                            'details': part_details,
-                            'mileage': row['mileage'],
-                            'kart_id': row['kart_id']
-                        })
+                        self.insert_part(Part.from_row(row))  # Handles missing details field
 
                     elif row['type']=='track':
                         id = row['id']
@@ -48,458 +800,836 @@ class CarPartDatabase:
                                 'type':'track',
                                 'mileage': row['mileage']
                             }
+
+                    elif row['type']=='interval':
+                        self.intervals[row['id']] = float(row['mileage'])
         except FileNotFoundError:
             pass
 
-    def save_data(self):
-        with open(self.filename, 'w', newline='') as file:
-            fieldnames = ['id', 'name','type', 'details', 'mileage', 'kart_id']
-            writer = csv.DictWriter(file, fieldnames=fieldnames)
+    @instrumented
+    def replay_journal(self):
+        # 'add' entries are relative, so an entry must never be replayed onto
+        # a CSV that already has it. Before compact() renames its new CSV
+        # into place, it appends a 'compacted' entry with that CSV's
+        # signature as the id. Everything before such an entry is in the
+        # CSV if the CSV still has that signature; a crash before the rename
+        # leaves the old CSV, and the entry is ignored.
+        self.journal_size = 0
+        try:
+            with open(self.journal_filename, 'r', newline='') as file:
+                rows = list(csv.DictReader(file, fieldnames=JOURNAL_FIELDS))
+        except FileNotFoundError:
+            return
+        compacted = ' '.join(map(str, file_signature(self.filename) or ()))
+        start = 0
+        for index, row in enumerate(rows):
+            if row['op'] == 'compacted' and row['id'] == compacted:
+                start = index + 1
+        for row in rows[start:]:
+            self.apply_entry(row.pop('op'), row)
+            self.journal_size += 1
+
+    def apply_entry(self, op, row):
+        # Puts leave an existing kart's or part's mileage alone, as mileage
+        # changes are journaled as 'add'. Journals from before that have no
+        # delta column (row['delta'] is None) and their puts set mileage.
+        if op == 'put':
+            self.apply_row(row, keep_mileage=row.get('delta') is not None)
+        elif op == 'del':
+            self.delete_row(row)
+        elif op == 'add':
+            self.add_row(row)
+
+    def apply_row(self, row, keep_mileage=False):
+        if row['type'] == 'kart':
+            kart = self.karts.get(row['id'])
+            self.karts[row['id']] = {
+                'name': row['name'],
+                'type': 'kart',
+                'mileage': kart['mileage'] if keep_mileage and kart else float(row['mileage']),
+                'kart_id': row['kart_id']
+            }
+        elif row['type'] == 'part':
+            part = self.parts_by_id.get(str(row['id']))
+            if part is None:
+                part = Part.from_row(row)
+                self.insert_part(part)
+            else:
+                self.move_part(part, row['kart_id'])
+                self.totals.discard(part)
+                part.name = sys.intern(row['name'])
+                part.details = row.get('details') or ''
+                if not keep_mileage:
+                    part.mileage = float(row['mileage'] or 0)
+                self.totals.add(part)
+                if self.search_index is not None:
+                    self.search_index.discard(part.id)
+                    self.search_index.add(part)
+            self.schedule_part(part)
+        elif row['type'] == 'track':
+            self.tracks[row['id']] = {
+                'name': row['name'],
+                'type': 'track',
+                'mileage': row['mileage']
+            }
+        elif row['type'] == 'interval':
+            self.intervals[row['id']] = float(row['mileage'])
+            self.reschedule_interval(row['id'])
+
+    def add_row(self, row):
+        # Adds row['delta'] to what the record has now, so mileage added by
+        # other instances in between is kept
+        delta = float(row['delta'])
+        if row['type'] == 'kart':
+            kart = self.karts.get(str(row['id']))
+            if kart is not None:
+                kart['mileage'] = settle(kart['mileage'] + delta, float(row['mileage']))
+        elif row['type'] == 'part':
+            part = self.parts_by_id.get(str(row['id']))
+            if part is not None:
+                mileage = settle(part.mileage + delta, float(row['mileage']))
+                self.totals.add_mileage(part, mileage - part.mileage)
+                part.mileage = mileage
+                self.schedule_part(part)
+
+    def delete_row(self, row):
+        if row['type'] == 'kart':
+            self.karts.pop(row['id'], None)
+        elif row['type'] == 'part':
+            part = self.parts_by_id.get(str(row['id']))
+            if part is not None:
+                self.discard_part(part)
+        elif row['type'] == 'track':
+            self.tracks.pop(row['id'], None)
+        elif row['type'] == 'interval':
+            if self.intervals.pop(row['id'], None) is not None:
+                self.reschedule_interval(row['id'])
+
+    def insert_part(self, part):
+        self.totals.add(part)
+        self.parts_by_id[part.id] = part
+        self.kart_parts.setdefault(part.kart_id, {})[part.id] = None
+        if self.search_index is not None:
+            self.search_index.add(part)
+
+    def move_part(self, part, kart_id):
+        old = self.kart_parts.get(part.kart_id)
+        if old is not None:
+            old.pop(part.id, None)
+        self.totals.discard(part)
+        part.kart_id = sys.intern(str(kart_id))
+        self.totals.add(part)
+        self.kart_parts.setdefault(part.kart_id, {})[part.id] = None
+
+    def discard_part(self, part):
+        self.totals.discard(part)
+        self.schedule.discard(part.id)
+        if self.search_index is not None:
+            self.search_index.discard(part.id)
+        del self.parts_by_id[part.id]
+        self.kart_parts.get(part.kart_id, {}).pop(part.id, None)
+
+    def get_part(self, part_id):
+        return self.parts_by_id.get(str(part_id))
+
+    def get_kart_parts(self, kart_id):
+        return [self.parts_by_id[part_id] for part_id in self.kart_parts.get(str(kart_id), ())]
+
+    @instrumented
+    def save_data(self, journal=None):
+        with self.write_lock:
+            if self.backend:
+                self.backend.save(self)
+            else:
+                self.write_csv(self.filename, journal)
+
+    def all_rows(self):
+        # Works from copies so the background writer can call it while the
+        # GUI thread keeps mutating
+        yield from list(self.parts)
+        for kart_id, kart_data in list(self.karts.items()):
+            yield self.kart_row(kart_id, kart_data)  # Save kart as well
+        for id, track_data in list(self.tracks.items()):
+            yield self.track_row(id, track_data)  # Save track
+        for key, limit in list(self.intervals.items()):
+            yield self.interval_row(key, limit)
+
+    @instrumented
+    def write_csv(self, filename, journal=None):
+        # Written next to the target and renamed over it, so a crash leaves
+        # either the old file or the new one. journal is the journal file the
+        # new CSV takes in; it is marked right before the rename.
+        temp_filename = filename + '.tmp'
+        with open(temp_filename, 'w', newline='') as file:
+            writer = csv.DictWriter(file, fieldnames=FIELDNAMES, extrasaction='ignore')
             writer.writeheader()
+            writer.writerows(self.all_rows())
+            file.flush()
+            os.fsync(file.fileno())
+            self.stats.add_bytes(file.tell())
+        if journal and os.path.exists(journal):
+            signature = ' '.join(map(str, file_signature(temp_filename)))  # kept by the rename
+            with open(journal, 'a', newline='') as file:
+                csv.DictWriter(file, fieldnames=JOURNAL_FIELDS).writerow({'op': 'compacted', 'id': signature})
+                file.flush()
+                os.fsync(file.fileno())
+        os.replace(temp_filename, filename)
+
+    @instrumented
+    def export_csv(self, filename):
+        self.write_csv(filename)
+
+    @instrumented
+    def import_csv(self, filename):
+        # Replaces the current contents with the CSV's, on disk as well:
+        # queued writes go out first and the journal is dropped, so neither
+        # can be replayed over the import
+        self.flush()
+        with self.write_lock, self.file_lock:
+            self.karts = {}
+            self.parts_by_id = {}
+            self.parts = self.parts_by_id.values()
+            self.tracks = {}
+            self.intervals = {}
+            self.read_csv(filename)
+            self.reindex()
+            self.undo_log.clear()
+            self.redo_log.clear()
+            self.note_files()  # the import wins over whatever is on disk
+            self.compact()
+        self.notify(None)
+
+    def kart_row(self, kart_id, kart_data=None):
+        if kart_data is None:
+            kart_data = self.karts[kart_id]
+        return {
+            'id': kart_id,
+            'name': kart_data['name'],
+            'type':'kart',
+            'details': '',  # Kart details are empty
+            'mileage': kart_data['mileage'],
+            'kart_id': kart_data['kart_id']
+        }
+
+    def track_row(self, id, track_data=None):
+        if track_data is None:
+            track_data = self.tracks[id]
+        return {
+            'id': id,
+            'name': track_data['name'],
+            'type':'track',
+            'details': '',  # Track details are empty
+            'mileage': track_data['mileage'],
+            'kart_id': ''   #no kart id
+        }
+
+    def interval_row(self, key, limit):
+        return {'id': key, 'name': '', 'type': 'interval', 'details': '', 'mileage': limit, 'kart_id': ''}
+
+    def reindex(self):
+        parts = list(self.parts)
+        self.parts_by_id = {}
+        self.parts = self.parts_by_id.values()
+        self.kart_parts = {}
+        self.search_index = None
+        self.totals = FleetTotals()
+        for part in parts:
+            self.insert_part(part)
+        self.reschedule()
+
+    @instrumented
+    def search_parts(self, query, offset=0, limit=100):
+        # Parts whose name or details have a word starting with each word of
+        # query; returns one page and whether there are more
+        if self.search_index is None:
+            self.search_index = SearchIndex(self.parts)
+        ids, more = self.search_index.search(query, offset, limit)
+        return [self.parts_by_id[part_id] for part_id in ids], more
+
+    def part_matches(self, part_id, query):
+        if self.search_index is None:
+            self.search_index = SearchIndex(self.parts)
+        return self.search_index.matches(str(part_id), split_words(query))
+
+    def interval_for(self, part):
+        limit = self.intervals.get('part:' + part.id)
+        if limit is None:
+            limit = self.intervals.get('type:' + part.name)
+        return limit
+
+    def schedule_part(self, part):
+        # O(log n); queues an alert when the part crosses service_margin
+        limit = self.interval_for(part)
+        if limit is None:
+            self.schedule.discard(part.id)
+            return
+        remaining = limit - part.mileage
+        previous = self.schedule.remaining.get(part.id)
+        self.schedule.update(part.id, remaining)
+        if remaining <= self.service_margin and (previous is None or previous > self.service_margin):
+            self.alerts.append((part.id, remaining))
+
+    def reschedule(self):
+        # Rebuilds the whole schedule in O(n), without alerts
+        self.schedule.remaining = {}
+        for part in self.parts:
+            limit = self.interval_for(part)
+            if limit is not None:
+                self.schedule.remaining[part.id] = limit - part.mileage
+        self.schedule.rebuild()
+
+    def reschedule_interval(self, key):
+        if key.startswith('part:'):
+            part = self.get_part(key[5:])
+            if part is not None:
+                self.schedule_part(part)
+        else:
+            name = key[5:]
             for part in self.parts:
-                writer.writerow(part)
-            for kart_id, kart_data in self.karts.items():
-                writer.writerow({  # Save kart as well
-                    'id': kart_id,
-                    'name': kart_data['name'],
-                    'type':'kart',
-                    'details': '',  # Kart details are empty
-                    'mileage': kart_data['mileage'],
-                    'kart_id': kart_data['kart_id']
-                })
-            for id, track_data in self.tracks.items():
-                writer.writerow({  # Save track
-                    'id': id,
-                    'name': track_data['name'],
-                    'type':'track',
-                    'details': '',  # Track details are empty
-                    'mileage': track_data['mileage'],
-                    'kart_id': ''   #no kart id
-                })
-
+                if part.name == name:
+                    self.schedule_part(part)
+
+    def take_alerts(self):
+        alerts, self.alerts = self.alerts, []
+        return alerts
+
+    def next_due(self, count=10, limit=None):
+        # [(remaining mileage, part), ...], most urgent first
+        return [(remaining, self.parts_by_id[part_id]) for remaining, part_id in self.schedule.next_due(count, limit)]
+
+    @instrumented
+    def set_service_interval(self, limit, part_id=None, part_name=None):
+        # Per part (part_id) or for every part with a name (part_name); a
+        # limit of None removes the interval
+        key = 'part:' + str(part_id) if part_id is not None else 'type:' + part_name
+        old = self.intervals.get(key)
+        undo = ('put', self.interval_row(key, old)) if old is not None else ('del', {'id': key, 'type': 'interval'})
+        if limit is None:
+            if self.intervals.pop(key, None) is None:
+                return
+            change = ('del', {'id': key, 'type': 'interval'})
+        else:
+            self.intervals[key] = float(limit)
+            change = ('put', self.interval_row(key, self.intervals[key]))
+        self.reschedule_interval(key)
+        self.commit([change])
+        self.remember('service interval', [(undo, change)])
+
+    @contextmanager
+    def batch(self, atomic=True):
+        # Mutations inside the block are written once on exit, or undone
+        # if the block raises. Undoing needs a copy of everything up front;
+        # with atomic=False there is no copy, and whatever was changed
+        # before the error is written like on a normal exit.
+        if self.batch_depth == 0:
+            self.undo_group = []
+        atomic = atomic and self.batch_depth == 0
+        if atomic:
+            saved = ({k: dict(v) for k, v in self.karts.items()},
+                     [part.copy() for part in self.parts],
+                     {k: dict(v) for k, v in self.tracks.items()},
+                     dict(self.intervals),
+                     {k: list(v) for k, v in self.track_totals.items()})
+        self.batch_depth += 1
+        try:
+            yield self
+        except BaseException:
+            if not atomic:
+                self.end_batch()
+                raise
+            self.batch_depth -= 1
+            if self.batch_depth == 0:
+                self.karts, self.parts, self.tracks, self.intervals, self.track_totals = saved
+                self.reindex()
+                self.pending = {}
+                self.undo_group = None
+                if self.history:
+                    self.history.discard()
+                self.notify(None)
+            raise
+        self.end_batch()
+
+    def end_batch(self):
+        self.batch_depth -= 1
+        if self.batch_depth == 0 and self.undo_group:
+            self.undo_log.append(('batch', self.undo_group))
+            self.redo_log.clear()
+        if self.batch_depth == 0:
+            self.undo_group = None
+        if self.batch_depth == 0 and self.pending:
+            changes = list(self.pending.values())
+            self.pending = {}
+            self.write_changes(changes)
+            self.notify(changes)
+
+    def subscribe(self, listener):
+        # listener(changes) is called after every commit with the changes
+        # written, or with None when everything may have changed
+        self.listeners.append(listener)
+
+    def notify(self, changes):
+        for listener in self.listeners:
+            listener(changes)
+
+    @instrumented
+    def commit(self, changes):
+        # changes is a list of ('put', row) / ('del', row) pairs, plus
+        # ('add', row) for "add row['delta'] to this kart's or part's
+        # mileage" (row['mileage'] being the result) and ('add_mileage', row)
+        # for "add row['mileage'] to every part on row['kart_id']", with the
+        # updated parts listed in row['parts']
+        if self.batch_depth:
+            # Rows are copied so the order of pending entries is the order
+            # the values were produced in; add and add_mileage are relative
+            # and must not be reordered or merged
+            for op, row in changes:
+                if op in ('add', 'add_mileage'):
+                    key = (op, next(self.pending_ids))
+                else:
+                    key = (row['type'], str(row['id']))
+                op, row = copy_change(op, row)
+                self.pending.pop(key, None)
+                self.pending[key] = (op, row)
+            return
+        self.write_changes(changes)
+        self.notify(changes)
+
+    def write_changes(self, changes):
+        events = self.history.take() if self.history else ()
+        if self.writer:
+            self.writer.submit(changes, events)
+        else:
+            self.persist(changes, events)
+
+    @instrumented
+    def persist(self, changes, events=()):
+        with self.write_lock, self.file_lock:
+            self.writes += 1
+            if events:
+                self.history.write(events)
+            if self.backend:
+                self.backend.write(changes)
+            elif not self.journal:
+                current = self.files_current()
+                if current and not self.on_writer_thread():
+                    self.save_data()
+                else:
+                    self.merge_into_files(changes)
+                if current:
+                    self.note_files()
+            else:
+                self.append_journal(changes)
+
+    def on_writer_thread(self):
+        # The writer thread must not read the records: the owner thread may
+        # be halfway through changing them, or in a batch it will roll back
+        return self.writer is not None and threading.current_thread() is self.writer.thread
+
+    def merge_into_files(self, changes):
+        # Applies changes to what is on disk rather than writing out our
+        # records, when those cannot be used: another instance saved since
+        # we last read the file (our copy catches up in check_for_changes),
+        # or this is the writer thread.
+        other = self.read_files()
+        for op, row in changes:
+            if op == 'put':
+                other.apply_row(row, keep_mileage=True)
+            elif op == 'del':
+                other.delete_row(row)
+            elif op == 'add':
+                other.add_row(row)
+            elif op == 'add_mileage':
+                for part in row['parts']:
+                    other.add_row(dict(part, delta=row['mileage']))
+        other.write_csv(self.filename)
+
+    @instrumented
+    def append_journal(self, changes):
+        current = self.files_current()
+        with open(self.journal_filename, 'a', newline='') as file:
+            start = file.tell()
+            writer = csv.DictWriter(file, fieldnames=JOURNAL_FIELDS, extrasaction='ignore')
+            for op, row in changes:
+                if op == 'add_mileage':
+                    for part in row['parts']:
+                        writer.writerow(dict(part, op='add', delta=row['mileage']))
+                        self.journal_size += 1
+                else:
+                    writer.writerow(dict(row, op=op))
+                    self.journal_size += 1
+            file.flush()
+            os.fsync(file.fileno())
+            end = file.tell()
+            self.stats.add_bytes(end - start)
+        if current:
+            self.note_files()
+        else:
+            self.own_appends.append((start, end))
+        if self.journal_size >= self.compact_threshold:
+            self.compact()
+
+    @instrumented
+    def compact(self):
+        # The journal is marked as the new CSV goes in (see replay_journal
+        # for how a crash in between is told apart), then removed once the
+        # snapshot is written
+        with self.write_lock, self.file_lock:
+            self.writes += 1
+            current = self.files_current()
+            if current and not self.on_writer_thread():
+                self.save_data(journal=self.journal_filename)
+                if self.snapshot_filename:
+                    self.write_snapshot()
+            else:
+                # Compacts what is on disk, the CSV plus the journal: another
+                # instance may have written since we last looked, or this is
+                # the writer thread, where our records may be mid-change
+                other = self.read_files()
+                other.write_csv(self.filename, journal=self.journal_filename)
+                if self.snapshot_filename:
+                    other.snapshot_filename = self.snapshot_filename
+                    other.write_snapshot()
+            if os.path.exists(self.journal_filename):
+                os.remove(self.journal_filename)
+            self.journal_size = 0
+            self.own_appends = []
+            if current:
+                self.note_files()
+
+    def new_id(self, type, records):
+        # The last id handed out per record type is kept in <database>.ids,
+        # shared by every instance, so two instances adding records between
+        # checks never pick the same id
+        with self.ids_lock:
+            try:
+                with open(self.ids_filename) as file:
+                    last_ids = json.load(file)
+            except (FileNotFoundError, ValueError):
+                last_ids = {}
+            new_id = max(last_ids.get(type, 0), len(records)) + 1
+            while str(new_id) in records:  # ids from before the file, or an import
+                new_id += 1
+            last_ids[type] = new_id
+            temp_filename = self.ids_filename + '.tmp'
+            try:
+                with open(temp_filename, 'w') as file:
+                    json.dump(last_ids, file)
+                os.replace(temp_filename, self.ids_filename)
+            except FileNotFoundError:
+                pass  # no directory; the write itself will fail
+        return str(new_id)
+
+    @instrumented
     def add_kart(self, kart_name):
-        new_id = str(len(self.karts) + 1)
+        new_id = self.new_id('kart', self.karts)
         self.karts[new_id] = {'id':new_id,'name': kart_name,'type':'kart', 'mileage': 0, 'kart_id': new_id}
-        self.save_data()
+        row = self.kart_row(new_id)
+        self.commit([('put', row)])
+        self.remember('add kart', [(('del', {'id': new_id, 'type': 'kart'}), ('put', row))])
+        return new_id
 
+    @instrumented
     def add_track(self, track_name, length):
-        new_id = str(len(self.tracks) + 1)
+        new_id = self.new_id('track', self.tracks)
         self.tracks[new_id] = {'name': track_name,'type':'track', 'mileage': length}
-        self.save_data()
+        row = self.track_row(new_id)
+        self.commit([('put', row)])
+        self.remember('add track', [(('del', {'id': new_id, 'type': 'track'}), ('put', row))])
+        return new_id
 
+    @instrumented
     def remove_kart(self, kart_id):
         if kart_id in self.karts:
+            row = self.kart_row(kart_id)
             del self.karts[kart_id]
-            self.save_data()
+            change = ('del', {'id': kart_id, 'type': 'kart'})
+            self.commit([change])
+            self.remember('remove kart', [(('put', row), change)])
 
+    @instrumented
     def remove_track(self, track_id):
         if track_id in self.tracks:
+            row = self.track_row(track_id)
             del self.tracks[track_id]
-            self.save_data()
+            self.track_totals.pop(track_id, None)
+            change = ('del', {'id': track_id, 'type': 'track'})
+            self.commit([change])
+            self.remember('remove track', [(('put', row), change)])
 
+    @instrumented
     def add_part_to_kart(self, kart_id, part_id):
         if kart_id in self.karts:
-            for i in self.parts:
-                if str(i['id']) == str(part_id):
-                    
-                    i['kart_id'] = kart_id
-
-            self.save_data()
-
+            changes = []
+            part = self.get_part(part_id)
+            if part is not None:
+                before = part.copy()
+                self.move_part(part, kart_id)
+                changes.append(('put', part))
+
+            self.commit(changes)
+            if part is not None:
+                self.remember('attach part', [(('put', before), ('put', part.copy()))])
+
+    @instrumented
     def remove_part_from_kart(self, kart_id, part_id):
-        for i in self.parts:
-            if str(i['id'])==str(part_id):
-                i['kart_id']=0
-        self.save_data()
-
+        changes = []
+        part = self.get_part(part_id)
+        if part is not None:
+            before = part.copy()
+            self.move_part(part, 0)
+            changes.append(('put', part))
+        self.commit(changes)
+        if part is not None:
+            self.remember('detach part', [(('put', before), ('put', part.copy()))])
+
+    @instrumented
     def add_part(self, part_name, part_details):
-        new_id = str(len(self.parts) + 1)
-        self.parts.append({'id': new_id,'type':'part', 'name': part_name, 'details': part_details, 'mileage': 0, 'kart_id': 0})
-        self.save_data()
-
+        new_id = self.new_id('part', self.parts_by_id)
+        self.insert_part(Part(new_id, part_name, part_details))
+        self.schedule_part(self.parts_by_id[new_id])
+        self.commit([('put', self.parts_by_id[new_id])])
+        self.remember('add part', [(('del', {'id': new_id, 'type': 'part'}), ('put', self.parts_by_id[new_id].copy()))])
+        return new_id
+
+    @instrumented
     def remove_part(self, part_id):
-        part = next((part for part in self.parts if part['id'] == part_id), None)
+        part = self.get_part(part_id)
         if part:
-            self.parts.remove(part)
-            self.save_data()
+            self.discard_part(part)
+            self.commit([('del', part)])
+            self.remember('remove part', [(('put', part.copy()), ('del', {'id': part.id, 'type': 'part'}))])
 
+    @instrumented
     def update_kart_mileage(self, kart_id, mileage):
         if kart_id in self.karts:
             self.karts[kart_id]['mileage'] += mileage
-            self.update_parts_mileage(kart_id, mileage)
-            self.save_data()
-
+            if self.history:
+                self.history.record('kart', kart_id, kart_id, mileage, self.karts[kart_id]['mileage'])
+            parts = self.update_parts_mileage(kart_id, mileage)
+            self.commit([('add', dict(self.kart_row(kart_id), delta=mileage)),
+                         ('add_mileage', {'type': 'part', 'id': '', 'kart_id': kart_id, 'mileage': mileage, 'parts': parts})])
+            self.remember('kart mileage', [self.mileage_step(kart_id, parts, (('', 0, mileage),))])
+
+    @instrumented
+    def apply_sessions(self, entries, undoable=True):
+        # entries are (kart_id, track_id, laps); track lengths are looked up
+        # once, laps are grouped per kart and each part is written to once.
+        # undoable=False keeps them out of the undo log (laps recorded by
+        # the timing hardware, which would push out the user's own changes).
+        lengths = {}
+        deltas = {}
+        for kart_id, track_id, laps in entries:
+            if track_id not in lengths:
+                lengths[track_id] = float(self.tracks[track_id]['mileage'])
+            if kart_id in self.karts:
+                deltas.setdefault(kart_id, []).append((track_id, laps, laps * lengths[track_id]))
+        history = self.history
+        totals = {}
+        changes = []
+        steps = []
+        for kart_id, kart_deltas in deltas.items():
+            # Added one session at a time so the sums match update_kart_mileage
+            kart = self.karts[kart_id]
+            for track_id, laps, mileage in kart_deltas:
+                kart['mileage'] += mileage
+                track_total = self.track_totals.setdefault(track_id, [0.0, 0])
+                track_total[0] += mileage
+                track_total[1] += laps
+                if history:
+                    history.record('kart', kart_id, kart_id, mileage, kart['mileage'], track_id, laps)
+            parts = self.get_kart_parts(kart_id)
+            for part in parts:
+                total = part['mileage']
+                for track_id, laps, mileage in kart_deltas:
+                    total += mileage
+                    if history:
+                        history.record('part', part.id, kart_id, mileage, total, track_id, laps)
+                self.totals.add_mileage(part, total - part.mileage)
+                part['mileage'] = total
+                self.schedule_part(part)
+            totals[kart_id] = sum(mileage for track_id, laps, mileage in kart_deltas)
+            changes.append(('add', dict(self.kart_row(kart_id), delta=totals[kart_id])))
+            changes.append(('add_mileage', {'type': 'part', 'id': '', 'kart_id': kart_id, 'mileage': totals[kart_id], 'parts': parts}))
+            steps.append(self.mileage_step(kart_id, parts, tuple(kart_deltas)))
+        if changes:
+            self.commit(changes)
+            if undoable:
+                self.remember('sessions', steps)
+        return totals
+
+    @instrumented
     def update_part_mileage(self, part_id, mileage):
-        for part in self.parts:
-            if str(part['id'])==str(part_id):
-                part['mileage'] += mileage
-            self.save_data()
-
+        changes = []
+        part = self.get_part(part_id)
+        if part is not None:
+            part['mileage'] += mileage
+            self.totals.add_mileage(part, mileage)
+            self.schedule_part(part)
+            if self.history:
+                self.history.record('part', part.id, part.kart_id, mileage, part.mileage)
+            changes.append(('add', dict(part, delta=mileage)))
+        self.commit(changes)
+        if part is not None:
+            self.remember('part mileage', [self.mileage_step(None, [part], (('', 0, mileage),))])
+
+    @instrumented
     def update_parts_mileage(self, kart_id, mileage):
-        for part in self.parts:
-            if str(part['kart_id'])==str(kart_id):
-                part['mileage'] += mileage
+        updated = self.get_kart_parts(kart_id)
+        for part in updated:
+            part['mileage'] += mileage
+            self.totals.add_mileage(part, mileage)
+            self.schedule_part(part)
+            if self.history:
+                self.history.record('part', part.id, kart_id, mileage, part.mileage)
+        return updated
+
+    def mileage_step(self, kart_id, parts, sessions):
+        # Mileage is undone by subtracting what was added, from the same parts
+        part_ids = tuple(part.id for part in parts)
+        return (('mileage', kart_id, part_ids, sessions, -1), ('mileage', kart_id, part_ids, sessions, 1))
+
+    def remember(self, label, steps):
+        if not steps or self.undo_log.maxlen == 0:
+            return
+        if self.undo_group is not None:
+            self.undo_group.extend(steps)  # the whole batch is one entry
+            return
+        self.undo_log.append((label, steps))
+        self.redo_log.clear()
+
+    def undo_label(self):
+        return self.undo_log[-1][0] if self.undo_log else None
+
+    def redo_label(self):
+        return self.redo_log[-1][0] if self.redo_log else None
+
+    @instrumented
+    def undo(self):
+        # Returns the label of what was undone, or None if there was nothing
+        if not self.undo_log:
+            return None
+        label, steps = self.undo_log.pop()
+        self.replay([undo for undo, redo in reversed(steps)])
+        self.redo_log.append((label, steps))
+        return label
+
+    @instrumented
+    def redo(self):
+        if not self.redo_log:
+            return None
+        label, steps = self.redo_log.pop()
+        self.replay([redo for undo, redo in steps])
+        self.undo_log.append((label, steps))
+        return label
+
+    def replay(self, operations):
+        # Everything an undo or redo touches goes out in one commit
+        changes = []
+        for operation in operations:
+            if operation[0] == 'mileage':
+                changes.extend(self.shift_mileage(*operation[1:]))
+            elif operation[0] == 'put':
+                self.apply_row(operation[1], keep_mileage=True)  # mileage has its own steps
+                changes.append(operation)
+            else:
+                self.delete_row(operation[1])
+                changes.append(operation)
+        self.commit(changes)
+
+    def shift_mileage(self, kart_id, part_ids, sessions, sign):
+        history = self.history
+        changes = []
+        delta = sign * sum(mileage for track_id, laps, mileage in sessions)
+        kart = self.karts.get(kart_id)
+        if kart is not None:
+            for track_id, laps, mileage in sessions:
+                kart['mileage'] += sign * mileage
+                if track_id in self.tracks:
+                    track_total = self.track_totals.setdefault(track_id, [0.0, 0])
+                    track_total[0] += sign * mileage
+                    track_total[1] += sign * laps
+                if history:
+                    history.record('kart', kart_id, kart_id, sign * mileage, kart['mileage'], track_id, sign * laps)
+            changes.append(('add', dict(self.kart_row(kart_id), delta=delta)))
+        for part_id in part_ids:
+            part = self.parts_by_id.get(part_id)
+            if part is None:
+                continue
+            total = part.mileage
+            for track_id, laps, mileage in sessions:
+                total += sign * mileage
+                if history:
+                    history.record('part', part.id, part.kart_id, sign * mileage, total, track_id, sign * laps)
+            self.totals.add_mileage(part, total - part.mileage)
+            part.mileage = total
+            self.schedule_part(part)
+            changes.append(('add', dict(part, delta=delta)))
+        return changes
+
+    def mileage_at(self, type, id, when):
+        # A kart's or part's mileage at a past time (seconds since the epoch);
+        # needs history=True. Records with no recorded changes have always
+        # had their current mileage.
+        self.flush()  # history events are written by the background writer
+        mileage = self.history.mileage_at(type, id, when)
+        if mileage is not None:
+            return mileage
+        if type == 'kart':
+            return self.karts[str(id)]['mileage']
+        return self.get_part(id)['mileage']
+
+    def mileage_between(self, type, id, start, end):
+        # {'mileage', 'laps'} put on a kart, part or track from start up to end
+        self.flush()
+        return self.history.totals(type, id, start, end)
 
     def get_parts_without_kart(self):
-        all_parts = set()
-        for kart_data in self.karts.values():
-            all_parts.update(part['name'] for part in kart_data['parts'].values())
-        return [part for part in self.parts if part['name'] not in all_parts]
-
-class CarPartGUI:
-    def __init__(self, root, database):
-        self.root = root
-        self.root.title("Car Part Database")
-
-        self.database = database
-        self.selected_kart = None  # Store the selected kart
-        self.selected_part = None  # Store the selected part
-
-        self.kart_frame = tk.Frame(root)
-        self.kart_frame.pack(side=tk.LEFT, padx=10, pady=10)
-
-        self.parts_frame = tk.Frame(root)
-        self.parts_frame.pack(side=tk.RIGHT, padx=10, pady=10)
-
-        self.track_frame = tk.Frame(root)
-        self.track_frame.pack(side=tk.BOTTOM, padx=10, pady=10)
-
-        self.init_kart_ui()
-        self.init_parts_ui()
-        self.init_kart_part_ui()
-        self.init_track_ui()
-
-
-    def init_kart_ui(self):
-        self.kart_name_label = tk.Label(self.kart_frame, text="Kart Name:")
-        self.kart_name_label.pack()
-
-        self.kart_name_entry = tk.Entry(self.kart_frame)
-        self.kart_name_entry.pack()
-
-        self.add_kart_button = tk.Button(self.kart_frame, text="Add Kart", command=self.add_kart)
-        self.add_kart_button.pack()
-
-        self.kart_listbox = tk.Listbox(self.kart_frame, selectmode=tk.SINGLE,width=30)
-        self.kart_listbox.pack()
-
-        # Display selected kart's name
-        self.selected_kart_label = tk.Label(self.kart_frame, text="Selected Kart:")
-        self.selected_kart_label.pack()
-
-        self.kart_listbox.bind("<<ListboxSelect>>", self.on_kart_selected)  # Bind selection event
-
-        #self.kart_parts_label = tk.Label(self.kart_frame, text="Parts on Kart:")
-        #self.kart_parts_label.pack()
-
-        #self.kart_parts_listbox = tk.Listbox(self.kart_frame)
-        #self.kart_parts_listbox.pack()
-
-
-
-        self.remove_kart_button = tk.Button(self.kart_frame, text="Remove Kart", command=self.remove_kart)
-        self.remove_kart_button.pack()
-        
-
-
-        self.refresh_karts()
-
-    def init_kart_part_ui(self):
-
-        self.kart_parts_label = tk.Label(self.kart_frame, text="Parts on Kart:")
-        self.kart_parts_label.pack()
-
-        self.kart_parts_listbox = tk.Listbox(self.kart_frame,width=30)
-        self.kart_parts_listbox.pack()
-
-        self.kart_parts_listbox.bind("<<ListboxSelect>>", self.on_kart_part_selected)  # Bind selection event
-        
-        self.kart_mileage_label = tk.Label(self.kart_frame, text="Kart Mileage:")
-        self.kart_mileage_label.pack()
-
-        self.kart_mileage_entry = tk.Entry(self.kart_frame)
-        self.kart_mileage_entry.pack()
-
-        self.update_kart_mileage_button = tk.Button(self.kart_frame, text="Update Kart Mileage", command=self.update_kart_mileage)
-        self.update_kart_mileage_button.pack()
-
-        self.refresh_parts()
-        self.refresh_karts()
-
-    def on_kart_selected(self, event):
-        selected_kart = self.kart_listbox.curselection()
-        if selected_kart:
-            self.selected_kart = list(self.database.karts.keys())[selected_kart[0]]
-            selected_kart_name = self.database.karts[self.selected_kart]['name']
-            self.selected_kart_label.config(text=f"Selected Kart: {selected_kart_name}")
-            self.refresh_kart_parts(self.selected_kart)
-        else:
-            pass
-    
-    def on_track_selected(self, event):
-        selected_track = self.track_listbox.curselection()
-        if selected_track:
-            self.selected_track = list(self.database.karts.keys())[selected_track[0]]
-            selected_track_name = self.database.tracks[self.selected_track]['name']
-            self.selected_track_label.config(text=f"Selected Track: {selected_track_name}")
-        else:
-            pass
-        
-
-    def on_part_selected(self, event):
-        selected_part = self.parts_listbox.curselection()
-        if selected_part:
-            self.selected_part = self.database.parts[selected_part[0]]
-            self.selected_part_label.config(text=f"Selected Part: {self.selected_part['name']}")
-            self.selected_part_details.config(text=f"Part Details: {self.selected_part['details']}")
-        else:
-            pass
-
-    def on_kart_part_selected(self, event):
-        selected_part = self.kart_parts_listbox.curselection()
-        kplist=[]
-        for part in self.database.parts:
-            if str(part['kart_id'])==str(self.selected_kart): 
-                kplist.append(part)
-        if selected_part:
-            self.selected_part = kplist[selected_part[0]]
-            self.selected_part_label.config(text=f"Selected Part: {self.selected_part['name']}")
-            self.selected_part_details.config(text=f"Part Details: {self.selected_part['details']}")
-        else:
-            pass
-
-    def init_parts_ui(self):
-        self.parts_label = tk.Label(self.parts_frame, text="Parts Database:")
-        self.parts_label.pack()
-
-        self.parts_listbox = tk.Listbox(self.parts_frame,width=30)
-        self.parts_listbox.pack()
-
-        self.selected_part_label = tk.Label(self.parts_frame, text="Selected Part:")
-        self.selected_part_label.pack()
-
-        self.selected_part_details = tk.Label(self.parts_frame)
-        self.selected_part_details.pack()
-
-        self.part_mileage_entry = tk.Entry(self.parts_frame)
-        self.part_mileage_entry.pack()
-
-        self.update_part_mileage_button = tk.Button(self.parts_frame, text="Update Part Mileage", command=self.update_part_mileage)
-        self.update_part_mileage_button.pack()
-
-        self.add_part_to_kart_button = tk.Button(self.parts_frame, text="Add Part to Kart", command=self.add_part_to_kart)
-        self.add_part_to_kart_button.pack()
-
-        self.remove_part_from_kart_button = tk.Button(self.parts_frame, text="Remove Part from Kart", command=self.remove_part_from_kart)
-        self.remove_part_from_kart_button.pack()
-
-        self.part_name_label = tk.Label(self.parts_frame, text="Part Name:")
-        self.part_name_label.pack()
-
-        self.part_name_entry = tk.Entry(self.parts_frame)
-        self.part_name_entry.pack()
-
-        self.part_details_label = tk.Label(self.parts_frame, text="Part Details:")
-        self.part_details_label.pack()
-
-        self.part_details_entry = tk.Text(self.parts_frame, height=4, width=30)
-        self.part_details_entry.pack()
-
-        self.add_part_button = tk.Button(self.parts_frame, text="Add Part", command=self.add_part)
-        self.add_part_button.pack()
-
-        self.remove_part_button = tk.Button(self.parts_frame, text="Remove Part", command=self.remove_part)
-        self.remove_part_button.pack()
-
-        self.parts_listbox.bind("<<ListboxSelect>>", self.on_part_selected)  # Bind selection event
-
-
-        self.refresh_parts()
-
-    def init_track_ui(self):
-        
-        self.track_label = tk.Label(self.track_frame, text="Track Database:")
-        self.track_label.pack()
-
-        self.track_listbox = tk.Listbox(self.track_frame,width=30)
-        self.track_listbox.pack()
-
-        self.selected_track_label = tk.Label(self.track_frame, text="Selected Track:")
-        self.selected_track_label.pack()
-
-
-        self.track_name_label = tk.Label(self.track_frame, text="Track Name:")
-        self.track_name_label.pack()
-
-        self.track_name_entry = tk.Entry(self.track_frame)
-        self.track_name_entry.pack()
-
-        self.track_length_label = tk.Label(self.track_frame, text="Track Length:")
-        self.track_length_label.pack()
-
-        self.track_length_entry = tk.Entry(self.track_frame)
-        self.track_length_entry.pack()
-
-        self.add_track_button = tk.Button(self.track_frame, text="Add Track", command=self.add_track)
-        self.add_track_button.pack()
-
-        self.remove_track_button = tk.Button(self.track_frame, text="Remove Track", command=self.remove_track)
-        self.remove_track_button.pack()
-
-        self.track_laps_entry = tk.Entry(self.track_frame)
-        self.track_laps_entry.pack()
-
-        self.remove_track_button = tk.Button(self.track_frame, text="Add laps to kart", command=self.update_kart_mileage)
-        self.remove_track_button.pack()
-
-        self.track_listbox.bind("<<ListboxSelect>>", self.on_track_selected)  # Bind selection event
-
-        self.refresh_tracks()
-
-    def refresh_karts(self):
-        self.kart_listbox.delete(0, tk.END)
-        for kart_id, kart_data in self.database.karts.items():
-            kart_name = f"{kart_data['name']} - Mileage: {kart_data['mileage']}"
-            self.kart_listbox.insert(tk.END, kart_name)
-
-    def refresh_tracks(self):
-        self.track_listbox.delete(0, tk.END)
-        for track_id,track_data in self.database.tracks.items():
-            track_name = f"{track_data['name']} - Length: {track_data['mileage']}"
-            self.track_listbox.insert(tk.END, track_name)
-
-    def refresh_kart_parts(self, kart_id):
-        self.kart_parts_listbox.delete(0, tk.END)
-        if kart_id in self.database.karts:
-            for part in self.database.parts:
-                if str(part['kart_id']) == str(kart_id):
-                    part_name = f"{part['name']} - Mileage: {part['mileage']}"
-                    self.kart_parts_listbox.insert(tk.END, part_name)
-
-            # Display selected kart's name
-            selected_kart_name = self.database.karts[kart_id]['name']
-            self.selected_kart_label.config(text=f"Selected Kart: {selected_kart_name}")
-        else:
-            self.selected_kart_label.config(text="Selected Kart:")
-
-    def refresh_parts(self):
-        self.parts_listbox.delete(0, tk.END)
-        for part in self.database.parts:
-            part_name = f"{part['name']} - Mileage: {part['mileage']}"
-            self.parts_listbox.insert(tk.END, part_name)
-
-    def add_kart(self):
-        kart_name = self.kart_name_entry.get()
-        if kart_name:
-            self.database.add_kart(kart_name)
-            self.kart_name_entry.delete(0, tk.END)
-            self.refresh_karts()
-
-    def add_track(self):
-        track_name = self.track_name_entry.get()
-        length = self.track_length_entry.get()
-        if track_name:
-            self.database.add_track(track_name,length)
-            self.track_name_entry.delete(0, tk.END)
-            self.track_length_entry.delete(0, tk.END)
-            self.refresh_tracks()
-
-    def remove_kart(self):
-        selected_kart = self.kart_listbox.curselection()
-        if selected_kart:
-            kart_id = list(self.database.karts.keys())[selected_kart[0]]
-            self.database.remove_kart(kart_id)
-            self.refresh_karts()
-            self.kart_parts_listbox.delete(0, tk.END)
-
-    def remove_track(self):
-        selected_track = self.track_listbox.curselection()
-        if selected_track:
-            track_id = list(self.database.karts.keys())[selected_track[0]]
-            self.database.remove_track(track_id)
-            self.refresh_tracks()
-            self.kart_parts_listbox.delete(0, tk.END)
-
-    def add_part_to_kart(self):
-        if self.selected_part and self.selected_kart:
-            part_id = self.selected_part['id']
-            self.database.add_part_to_kart(self.selected_kart, part_id)  # Use selected kart
-            self.refresh_kart_parts(self.selected_kart)  # Refresh parts of selected kart
-            self.refresh_parts()
-
-    def remove_part_from_kart(self):
-        if self.selected_part and self.selected_kart:
-            part_id = self.selected_part['id']
-            self.database.remove_part_from_kart(self.selected_kart, part_id)
-            self.refresh_kart_parts(self.selected_kart)
-            self.refresh_parts()
-
-    def add_part(self):
-        part_name = self.part_name_entry.get()
-        part_details = self.part_details_entry.get("1.0", tk.END).strip()
-        if part_details=='':
-            part_details="None"
-        if part_name:
-            self.database.add_part(part_name, part_details)
-            self.part_name_entry.delete(0, tk.END)
-            self.part_details_entry.delete("1.0", tk.END)
-            self.refresh_parts()
-
-
-    def remove_part(self):
-        selected_part = self.parts_listbox.curselection()
-        if selected_part:
-            part_id = self.database.parts[selected_part[0]]['id']
-            self.database.remove_part(part_id)
-            self.refresh_kart_parts(self.selected_kart)
-            self.refresh_parts()
-
-    def update_kart_mileage(self):
-        manual = 0
-        auto = 0
-        
-        
-        if self.kart_mileage_entry.get() != '':
-            manual = int(self.kart_mileage_entry.get())
-        if self.track_laps_entry.get() != '':
-            auto = int(self.track_laps_entry.get())*float(self.database.tracks[self.selected_track[0]]['mileage'])
-            
-        
-
-        if auto > 0:
-            mileage = auto
-        else:
-            mileage = manual
-
-        if mileage >= 0:
-            kart_id = self.selected_kart
-            self.database.update_kart_mileage(kart_id, mileage)
-            self.refresh_karts()
-            self.refresh_kart_parts(kart_id)
-            self.refresh_parts()
-            self.kart_mileage_entry.delete(0, tk.END)
-            self.track_laps_entry.delete(0, tk.END)
-        else:
-            messagebox.showerror("Error", "Invalid kart selection or mileage value.")
-
-    def update_part_mileage(self):
-        mileage = int(self.part_mileage_entry.get())
-        
-        if mileage >= 0:
-            kart_id = self.selected_kart
-            part_id = self.selected_part['id']
-            print(mileage,part_id)
-            self.database.update_part_mileage(part_id, mileage)
-            self.refresh_karts()
-            self.refresh_kart_parts(kart_id)
-            self.refresh_parts()
-            self.part_mileage_entry.delete(0, tk.END)
-        else:
-            messagebox.showerror("Error", "Invalid kart selection or mileage value.")
+        return self.get_kart_parts(0)
+
+    def kart_total_mileage(self, kart_id):
+        # The kart's own mileage plus that of every part on it
+        kart_id = str(kart_id)
+        return self.karts[kart_id]['mileage'] + self.totals.kart_mileage.get(kart_id, 0.0)
+
+    def fleet_summary(self):
+        # Costs O(karts + tracks + part names), whatever the number of parts.
+        # Track totals are saved only in the history, so without it they
+        # would restart from zero with every run: None says they are unknown.
+        kart_mileage = self.totals.kart_mileage
+        return {
+            'karts': {kart_id: {'mileage': kart_data['mileage'],
+                                'parts': len(self.kart_parts.get(kart_id, ())),
+                                'parts_mileage': kart_mileage.get(kart_id, 0.0),
+                                'total_mileage': kart_data['mileage'] + kart_mileage.get(kart_id, 0.0)}
+                      for kart_id, kart_data in self.karts.items()},
+            'tracks': {track_id: {'mileage': self.track_totals.get(track_id, [0.0, 0])[0],
+                                  'laps': self.track_totals.get(track_id, [0.0, 0])[1]}
+                       for track_id in self.tracks} if self.history else None,
+            'part_types': {name: {'parts': count, 'mileage': mileage, 'average_mileage': mileage / count}
+                           for name, (count, mileage) in self.totals.part_types.items()},
+            'parts': len(self.parts),
+            'unattached_parts': len(self.kart_parts.get('0', ())),
+        }
+
+def __getattr__(name):
+    # The GUI lives in gui.py so that scripts and tests using only
+    # CarPartDatabase never import tkinter
+    if name in ('CarPartGUI', 'ListView'):
+        import gui
+        return getattr(gui, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 if __name__ == "__main__":
-    db = CarPartDatabase("car_parts.csv")
+    db = CarPartDatabase("car_parts.csv", journal=True, background=True, snapshot=True, history=True)
+
+    import tkinter as tk
+    from gui import CarPartGUI
 
     root = tk.Tk()
     gui = CarPartGUI(root, db)
+    if len(sys.argv) > 1:  # Serial port of the lap counter
+        from lap_ingest import LapIngestor
+        ingestor = LapIngestor(db)
+        ingestor.start(sys.argv[1])
+        gui.attach_lap_ingestor(ingestor)
     root.mainloop()
\ No newline at end of file
@@ -0,0 +1,179 @@
+import argparse
+import csv
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+import tkinter as tk
+
+from app import FIELDNAMES, CarPartDatabase
+from gui import CarPartGUI, ListView
+
+PART_NAMES = ['Chain', 'Sprocket', 'Axle', 'Brake disc', 'Brake pads', 'Clutch', 'Piston', 'Carburettor',
+              'Front tyre', 'Rear tyre', 'Spark plug', 'Bearing', 'Steering rod', 'Seat', 'Radiator']
+
+def generate_fleet(filename, parts, karts, tracks, seed=0):
+    # Writes a car_parts.csv with the given number of each record; about a
+    # fifth of the parts are left off any kart
+    rng = random.Random(seed)
+    with open(filename, 'w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(FIELDNAMES)
+        for part_id in range(1, parts + 1):
+            kart_id = rng.randint(1, karts) if rng.random() < 0.8 else 0
+            writer.writerow([part_id, rng.choice(PART_NAMES), 'part', f"Batch {rng.randint(1, 500)}",
+                             round(rng.uniform(0, 3000), 1), kart_id])
+        for kart_id in range(1, karts + 1):
+            writer.writerow([kart_id, f"Kart {kart_id}", 'kart', '', round(rng.uniform(0, 5000), 1), kart_id])
+        for track_id in range(1, tracks + 1):
+            writer.writerow([track_id, f"Track {track_id}", 'track', '', round(rng.uniform(0.6, 1.6), 3), ''])
+
+class StubListbox:
+    # Just enough of tk.Listbox for ListView when there is no display
+    def __init__(self, height=10):
+        self.items = []
+        self.height = height
+
+    def config(self, **options):
+        pass
+
+    def cget(self, option):
+        return self.height
+
+    def delete(self, first, last=None):
+        if last == tk.END:
+            del self.items[first:]
+        else:
+            del self.items[first]
+
+    def insert(self, index, *items):
+        if index == tk.END:
+            self.items.extend(items)
+        else:
+            self.items[index:index] = items
+
+    def nearest(self, y):
+        return 0
+
+    def winfo_height(self):
+        return 1
+
+    def selection_includes(self, index):
+        return False
+
+    def selection_set(self, index):
+        pass
+
+class StubLabel:
+    def config(self, **options):
+        pass
+
+def make_gui(database):
+    # A real (withdrawn) window when Tk can start, stub widgets otherwise
+    try:
+        root = tk.Tk()
+    except tk.TclError:
+        gui = CarPartGUI.__new__(CarPartGUI)
+        gui.database = database
+        gui.selected_kart = gui.selected_part = gui.selected_track = None
+        gui.search_query = ''
+        gui.selected_kart_label = StubLabel()
+        gui.search_page_label = StubLabel()
+        gui.kart_view = ListView(StubListbox(), gui.format_kart)
+        gui.kart_parts_view = ListView(StubListbox(), gui.format_part)
+        gui.parts_view = ListView(StubListbox(), gui.format_part)
+        gui.track_view = ListView(StubListbox(), gui.format_track)
+        return gui, 'stub'
+    root.withdraw()
+    return CarPartGUI(root, database), 'tk'
+
+def timed(function, repeat):
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - started)
+    return {
+        'repeat': repeat,
+        'min': min(times),
+        'median': statistics.median(times),
+        'mean': statistics.mean(times),
+    }
+
+def apply_sessions_per_call(database, sessions):
+    # What apply_sessions replaces: one update_kart_mileage (and one commit)
+    # per session
+    for kart_id, track_id, laps in sessions:
+        database.update_kart_mileage(kart_id, laps * float(database.tracks[track_id]['mileage']))
+
+def open_database(filename, storage):
+    if storage == 'sqlite':
+        return CarPartDatabase(filename, backend='sqlite')
+    return CarPartDatabase(filename, journal=storage == 'journal')
+
+def run(parts, karts, tracks, storage='csv', repeat=5, seed=0):
+    rng = random.Random(seed)
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        filename = os.path.join(directory, 'car_parts.csv')
+        generate_fleet(filename, parts, karts, tracks, seed)
+        if storage == 'sqlite':
+            csv_filename, filename = filename, os.path.join(directory, 'car_parts.db')
+            CarPartDatabase(filename, backend='sqlite').import_csv(csv_filename)
+
+        results['load_data'] = timed(lambda: open_database(filename, storage), repeat)
+        database = open_database(filename, storage)
+        kart_ids = list(database.karts)
+        part_ids = list(database.parts_by_id)
+        track_ids = list(database.tracks)
+
+        results['save_data'] = timed(database.save_data, repeat)
+        results['update_kart_mileage'] = timed(
+            lambda: database.update_kart_mileage(rng.choice(kart_ids), 1.5), repeat)
+        results['update_part_mileage'] = timed(
+            lambda: database.update_part_mileage(rng.choice(part_ids), 1.5), repeat)
+        results['add_part_to_kart'] = timed(
+            lambda: database.add_part_to_kart(rng.choice(kart_ids), rng.choice(part_ids)), repeat)
+        sessions = [(rng.choice(kart_ids), rng.choice(track_ids), rng.randint(1, 30)) for _ in range(karts)]
+        results['apply_sessions'] = timed(lambda: database.apply_sessions(sessions), repeat)
+        results['apply_sessions_per_call'] = timed(lambda: apply_sessions_per_call(database, sessions), repeat)
+        results['fleet_summary'] = timed(database.fleet_summary, repeat)
+
+        gui, gui_kind = make_gui(database)
+        results['refresh_parts'] = timed(gui.refresh_parts, repeat)
+        results['refresh_karts'] = timed(gui.refresh_karts, repeat)
+        results['refresh_tracks'] = timed(gui.refresh_tracks, repeat)
+        results['refresh_kart_parts'] = timed(lambda: gui.refresh_kart_parts(rng.choice(kart_ids)), repeat)
+        database.close()
+
+    return {
+        'config': {'parts': parts, 'karts': karts, 'tracks': tracks, 'storage': storage,
+                   'repeat': repeat, 'seed': seed, 'gui': gui_kind, 'python': sys.version.split()[0]},
+        'results': results,
+    }
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Time CarPartDatabase and CarPartGUI on synthetic fleets.")
+    parser.add_argument('--parts', default='100,10000', help="comma separated part counts")
+    parser.add_argument('--karts', type=int, default=50)
+    parser.add_argument('--tracks', type=int, default=20)
+    parser.add_argument('--storage', choices=['csv', 'journal', 'sqlite'], default='csv')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help="write the results as JSON to this file instead of stdout")
+    args = parser.parse_args(argv)
+
+    runs = [run(int(parts), args.karts, args.tracks, args.storage, args.repeat, args.seed)
+            for parts in args.parts.split(',')]
+    report = json.dumps(runs, indent=2)
+    if args.output:
+        with open(args.output, 'w') as file:
+            file.write(report + '\n')
+    else:
+        print(report)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+import argparse
+import csv
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from app import CarPartDatabase
+
+# Jobs run once per database file, each in its own process. An input path
+# may contain {name}, which is replaced by the database's file name without
+# its extension, so each team can have its own log: sessions/{name}.csv
+
+def open_database(filename):
+    if filename.endswith(('.db', '.sqlite')):
+        return CarPartDatabase(filename, backend='sqlite', history=True)
+    return CarPartDatabase(filename, journal=True, snapshot=True, history=True)
+
+def close_database(database):
+    if database.backend:
+        database.backend.close()
+    elif database.journal_size:
+        database.compact()  # Leaves a plain CSV for the GUI to pick up
+
+def input_path(template, database_filename):
+    name = os.path.splitext(os.path.basename(database_filename))[0]
+    return template.format(name=name)
+
+def read_rows(filename, *fields):
+    with open(filename, newline='') as file:
+        for row in csv.DictReader(file):
+            yield tuple(row[field].strip() for field in fields)
+
+def import_sessions(database, options):
+    # CSV with kart_id, track_id, laps columns
+    entries = []
+    skipped = 0
+    for kart_id, track_id, laps in read_rows(input_path(options.input, database.filename), 'kart_id', 'track_id', 'laps'):
+        if kart_id in database.karts and track_id in database.tracks:
+            entries.append((kart_id, track_id, int(laps)))
+        else:
+            skipped += 1
+    totals = database.apply_sessions(entries)
+    return {'sessions': len(entries), 'skipped': skipped, 'mileage_added': sum(totals.values())}
+
+def attach_parts(database, options):
+    # CSV with part_id, kart_id columns
+    attached = 0
+    skipped = 0
+    with database.batch():
+        for part_id, kart_id in read_rows(input_path(options.input, database.filename), 'part_id', 'kart_id'):
+            if kart_id in database.karts and database.get_part(part_id) is not None:
+                database.add_part_to_kart(kart_id, part_id)
+                attached += 1
+            else:
+                skipped += 1
+    return {'attached': attached, 'skipped': skipped}
+
+def export_report(database, options):
+    filename = input_path(options.output, database.filename)
+    with open(filename, 'w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(['kart_id', 'kart', 'part_id', 'part', 'mileage'])
+        for kart_id, kart_data in database.karts.items():
+            writer.writerow([kart_id, kart_data['name'], '', '', kart_data['mileage']])
+            for part in database.get_kart_parts(kart_id):
+                writer.writerow([kart_id, kart_data['name'], part.id, part.name, part.mileage])
+        for part in database.get_kart_parts(0):
+            writer.writerow(['', '', part.id, part.name, part.mileage])
+    return {'report': filename, 'karts': len(database.karts), 'parts': len(database.parts)}
+
+def replay_laps(database, options):
+    # A lap counter log, one "LAP <kart_id> <track_id> <laps>" line per event
+    from lap_ingest import LapIngestor
+
+    ingestor = LapIngestor(database)
+    with open(input_path(options.input, database.filename)) as file:
+        for line in file:
+            ingestor.feed(line)
+    batch = ingestor.take()
+    if batch:
+        ingestor.apply(batch)
+    return {key: ingestor.counters[key] for key in ('events', 'bad_lines', 'dropped_events')}
+
+JOBS = {
+    'import-sessions': import_sessions,
+    'attach': attach_parts,
+    'report': export_report,
+    'replay': replay_laps,
+}
+
+def run_job(command, filename, options):
+    started = time.perf_counter()
+    summary = {'database': filename}
+    try:
+        if not os.path.exists(filename):
+            raise FileNotFoundError(f"no such database: {filename}")
+        database = open_database(filename)
+        try:
+            summary.update(JOBS[command](database, options))
+        finally:
+            close_database(database)
+    except Exception as error:
+        summary['error'] = f"{type(error).__name__}: {error}"
+    summary['seconds'] = time.perf_counter() - started
+    return summary
+
+def print_summary(command, summaries, elapsed, file=sys.stdout):
+    failed = [summary for summary in summaries if 'error' in summary]
+    for summary in summaries:
+        details = ', '.join(f"{key}={format_value(value)}" for key, value in summary.items()
+                            if key not in ('database', 'seconds'))
+        print(f"{summary['database']}: {details} ({summary['seconds']:.2f}s)", file=file)
+    totals = {}
+    for summary in summaries:
+        for key, value in summary.items():
+            if key != 'seconds' and isinstance(value, (int, float)):
+                totals[key] = totals.get(key, 0) + value
+    print(f"{command}: {len(summaries) - len(failed)}/{len(summaries)} databases ok in {elapsed:.2f}s"
+          + ''.join(f", {key}={format_value(value)}" for key, value in totals.items()), file=file)
+
+def format_value(value):
+    return f"{value:.1f}" if isinstance(value, float) else str(value)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Batch jobs over one or more parts databases.")
+    parser.add_argument('--jobs', type=int, default=None, help="worker processes (default: one per CPU)")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    command = commands.add_parser('import-sessions', help="add mileage from a kart_id,track_id,laps CSV")
+    command.add_argument('--input', required=True)
+    command = commands.add_parser('attach', help="attach parts to karts from a part_id,kart_id CSV")
+    command.add_argument('--input', required=True)
+    command = commands.add_parser('report', help="write a mileage report CSV per database")
+    command.add_argument('--output', default='{name}-report.csv')
+    command = commands.add_parser('replay', help="replay a lap counter log")
+    command.add_argument('--input', required=True)
+    for command in commands.choices.values():
+        command.add_argument('databases', nargs='+', metavar='DATABASE')
+    options = parser.parse_args(argv)
+
+    started = time.perf_counter()
+    if len(options.databases) == 1:
+        summaries = [run_job(options.command, options.databases[0], options)]
+    else:
+        with ProcessPoolExecutor(options.jobs) as pool:
+            summaries = list(pool.map(run_job, [options.command] * len(options.databases),
+                                      options.databases, [options] * len(options.databases)))
+    print_summary(options.command, summaries, time.perf_counter() - started)
+    return 1 if any('error' in summary for summary in summaries) else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,734 @@
+import bisect
+import queue
+import threading
+import tkinter as tk
+from tkinter import messagebox
+
+from instrumentation import timed_handler
+
+SEARCH_DELAY = 150  # ms of no typing before searching
+SEARCH_PAGE_SIZE = 100
+FILE_CHECK_INTERVAL = 1000  # ms between looks for other instances' writes
+FILE_READ_POLL = 50  # ms between looks for a file read in progress to finish
+
+class ListView:
+    # Keeps a Listbox in step with a list of record keys. Rows are only
+    # formatted once they are scrolled into view; until then (or after a
+    # change) they are stale and the listbox holds whatever was there.
+    # Each key keeps the slot it was given when added, and removed slots
+    # are listed in gaps, so a removal does not renumber the rows after it.
+    def __init__(self, listbox, format_row):
+        self.listbox = listbox
+        self.format_row = format_row
+        self.keys = []
+        self.positions = {}  # key -> slot
+        self.gaps = []  # sorted slots of removed rows
+        self.stale = set()
+        self.listbox.config(yscrollcommand=self.on_scroll)
+
+    def set(self, keys):
+        self.listbox.delete(0, tk.END)
+        self.keys = list(keys)
+        self.positions = {key: i for i, key in enumerate(self.keys)}
+        self.gaps = []
+        self.stale = set(self.keys)
+        if self.keys:
+            self.listbox.insert(tk.END, *([''] * len(self.keys)))
+        self.render_visible()
+
+    def key_at(self, index):
+        return self.keys[index]
+
+    def index_of(self, key):
+        slot = self.positions[key]
+        return slot - bisect.bisect_left(self.gaps, slot)
+
+    def upsert(self, key):
+        if key not in self.positions:
+            self.positions[key] = len(self.keys) + len(self.gaps)
+            self.keys.append(key)
+            self.listbox.insert(tk.END, '')
+        self.stale.add(key)
+        self.render_visible()
+
+    def remove(self, key):
+        if key not in self.positions:
+            return
+        index = self.index_of(key)
+        bisect.insort(self.gaps, self.positions.pop(key))
+        del self.keys[index]
+        if len(self.gaps) > len(self.keys):
+            # Renumbered once the gaps outnumber the rows, so that costs
+            # O(1) per removal on average
+            self.positions = {key: i for i, key in enumerate(self.keys)}
+            self.gaps = []
+        self.stale.discard(key)
+        self.listbox.delete(index)
+        self.render_visible()
+
+    def visible_range(self):
+        first = self.listbox.nearest(0)
+        rows = max(int(self.listbox.cget('height')), self.listbox.nearest(self.listbox.winfo_height()) - first + 1)
+        return first, min(first + rows, len(self.keys))
+
+    def render_visible(self):
+        if not self.stale:
+            return
+        first, last = self.visible_range()
+        for index in range(first, last):
+            key = self.keys[index]
+            if key in self.stale:
+                self.stale.discard(key)
+                selected = self.listbox.selection_includes(index)
+                self.listbox.delete(index)
+                self.listbox.insert(index, self.format_row(key))
+                if selected:
+                    self.listbox.selection_set(index)
+
+    def on_scroll(self, first, last):
+        self.render_visible()
+
+class CarPartGUI:
+    def __init__(self, root, database):
+        self.root = root
+        self.root.title("Car Part Database")
+
+        self.database = database
+        self.selected_kart = None  # Store the selected kart
+        self.selected_part = None  # Store the selected part
+        self.selected_track = None
+        self.search_query = ''
+        self.search_page = 0
+        self.search_more = False
+        self.search_job = None
+
+        self.kart_frame = tk.Frame(root)
+        self.kart_frame.pack(side=tk.LEFT, padx=10, pady=10)
+
+        self.parts_frame = tk.Frame(root)
+        self.parts_frame.pack(side=tk.RIGHT, padx=10, pady=10)
+
+        self.track_frame = tk.Frame(root)
+        self.track_frame.pack(side=tk.BOTTOM, padx=10, pady=10)
+
+        self.service_frame = tk.Frame(root)
+        self.service_frame.pack(side=tk.BOTTOM, padx=10, pady=10)
+
+        self.summary_frame = tk.Frame(root)
+        self.summary_frame.pack(side=tk.BOTTOM, padx=10, pady=10)
+
+        self.init_kart_ui()
+        self.init_parts_ui()
+        self.init_kart_part_ui()
+        self.init_track_ui()
+        self.init_service_ui()
+        self.init_summary_ui()
+        self.init_undo_ui()
+
+        self.database.subscribe(self.on_database_changed)
+        self.root.protocol("WM_DELETE_WINDOW", self.on_close)
+        self.check_write_errors()
+        self.file_reader = None
+        self.file_read = None
+        self.check_for_changes()
+
+    def check_write_errors(self):
+        # Saves happen on the writer thread; its errors are shown from here
+        if self.database.writer:
+            try:
+                error = self.database.writer.errors.get_nowait()
+            except queue.Empty:
+                pass
+            else:
+                messagebox.showerror("Error", f"Could not save data: {error}")
+            self.root.after(500, self.check_write_errors)
+
+    def check_for_changes(self):
+        # Another instance (e.g. the workshop PC) may share the files; what
+        # it wrote comes back through on_database_changed like our own
+        # changes. The files are read on a thread of their own, and only
+        # applied here.
+        if self.file_reader is None:
+            if self.database.ready_for_file_changes():
+                self.file_reader = threading.Thread(target=self.read_file_changes, daemon=True)
+                self.file_reader.start()
+        elif not self.file_reader.is_alive():
+            self.file_reader = None
+            read, error = self.file_read
+            if error is not None:
+                messagebox.showerror("Error", f"Could not reload data: {error}")
+            else:
+                self.database.apply_file_changes(read)
+        self.root.after(FILE_READ_POLL if self.file_reader else FILE_CHECK_INTERVAL, self.check_for_changes)
+
+    def read_file_changes(self):
+        try:
+            self.file_read = (self.database.read_file_changes(), None)
+        except OSError as error:
+            self.file_read = (None, error)
+
+    def attach_lap_ingestor(self, ingestor):
+        # Laps read by the ingestor's thread are applied here, on the Tk thread
+        self.lap_ingestor = ingestor
+        self.drain_laps()
+
+    def drain_laps(self):
+        self.lap_ingestor.drain()
+        self.root.after(100, self.drain_laps)
+
+    def on_close(self):
+        self.database.close()  # Flush pending writes before exiting
+        self.root.destroy()
+
+    def init_kart_ui(self):
+        self.kart_name_label = tk.Label(self.kart_frame, text="Kart Name:")
+        self.kart_name_label.pack()
+
+        self.kart_name_entry = tk.Entry(self.kart_frame)
+        self.kart_name_entry.pack()
+
+        self.add_kart_button = tk.Button(self.kart_frame, text="Add Kart", command=self.add_kart)
+        self.add_kart_button.pack()
+
+        self.kart_listbox = tk.Listbox(self.kart_frame, selectmode=tk.SINGLE,width=30)
+        self.kart_listbox.pack()
+        self.kart_view = ListView(self.kart_listbox, self.format_kart)
+
+        # Display selected kart's name
+        self.selected_kart_label = tk.Label(self.kart_frame, text="Selected Kart:")
+        self.selected_kart_label.pack()
+
+        self.kart_listbox.bind("<<ListboxSelect>>", self.on_kart_selected)  # Bind selection event
+
+        #self.kart_parts_label = tk.Label(self.kart_frame, text="Parts on Kart:")
+        #self.kart_parts_label.pack()
+
+        #self.kart_parts_listbox = tk.Listbox(self.kart_frame)
+        #self.kart_parts_listbox.pack()
+
+
+
+        self.remove_kart_button = tk.Button(self.kart_frame, text="Remove Kart", command=self.remove_kart)
+        self.remove_kart_button.pack()
+        
+
+
+        self.refresh_karts()
+
+    def init_kart_part_ui(self):
+
+        self.kart_parts_label = tk.Label(self.kart_frame, text="Parts on Kart:")
+        self.kart_parts_label.pack()
+
+        self.kart_parts_listbox = tk.Listbox(self.kart_frame,width=30)
+        self.kart_parts_listbox.pack()
+        self.kart_parts_view = ListView(self.kart_parts_listbox, self.format_part)
+
+        self.kart_parts_listbox.bind("<<ListboxSelect>>", self.on_kart_part_selected)  # Bind selection event
+        
+        self.kart_mileage_label = tk.Label(self.kart_frame, text="Kart Mileage:")
+        self.kart_mileage_label.pack()
+
+        self.kart_mileage_entry = tk.Entry(self.kart_frame)
+        self.kart_mileage_entry.pack()
+
+        self.update_kart_mileage_button = tk.Button(self.kart_frame, text="Update Kart Mileage", command=self.update_kart_mileage)
+        self.update_kart_mileage_button.pack()
+
+        self.refresh_parts()
+        self.refresh_karts()
+
+    @timed_handler
+    def on_kart_selected(self, event):
+        selected_kart = self.kart_listbox.curselection()
+        if selected_kart:
+            self.selected_kart = self.kart_view.key_at(selected_kart[0])
+            selected_kart_name = self.database.karts[self.selected_kart]['name']
+            self.selected_kart_label.config(text=f"Selected Kart: {selected_kart_name}")
+            self.refresh_kart_parts(self.selected_kart)
+            self.refresh_summary()
+        else:
+            pass
+    
+    @timed_handler
+    def on_track_selected(self, event):
+        selected_track = self.track_listbox.curselection()
+        if selected_track:
+            self.selected_track = self.track_view.key_at(selected_track[0])
+            selected_track_name = self.database.tracks[self.selected_track]['name']
+            self.selected_track_label.config(text=f"Selected Track: {selected_track_name}")
+        else:
+            pass
+        
+
+    @timed_handler
+    def on_part_selected(self, event):
+        selected_part = self.parts_listbox.curselection()
+        if selected_part:
+            self.selected_part = self.database.get_part(self.parts_view.key_at(selected_part[0]))
+            self.selected_part_label.config(text=f"Selected Part: {self.selected_part['name']}")
+            self.selected_part_details.config(text=f"Part Details: {self.selected_part['details']}")
+        else:
+            pass
+
+    @timed_handler
+    def on_kart_part_selected(self, event):
+        selected_part = self.kart_parts_listbox.curselection()
+        if selected_part:
+            self.selected_part = self.database.get_part(self.kart_parts_view.key_at(selected_part[0]))
+            self.selected_part_label.config(text=f"Selected Part: {self.selected_part['name']}")
+            self.selected_part_details.config(text=f"Part Details: {self.selected_part['details']}")
+        else:
+            pass
+
+    def init_parts_ui(self):
+        self.parts_label = tk.Label(self.parts_frame, text="Parts Database:")
+        self.parts_label.pack()
+
+        self.search_entry = tk.Entry(self.parts_frame)
+        self.search_entry.pack()
+        self.search_entry.bind("<KeyRelease>", self.on_search_typed)
+
+        self.parts_listbox = tk.Listbox(self.parts_frame,width=30)
+        self.parts_listbox.pack()
+        self.parts_view = ListView(self.parts_listbox, self.format_part)
+
+        self.search_page_label = tk.Label(self.parts_frame, text="")
+        self.search_page_label.pack()
+
+        self.previous_page_button = tk.Button(self.parts_frame, text="Previous", command=self.previous_search_page)
+        self.previous_page_button.pack()
+
+        self.next_page_button = tk.Button(self.parts_frame, text="Next", command=self.next_search_page)
+        self.next_page_button.pack()
+
+        self.selected_part_label = tk.Label(self.parts_frame, text="Selected Part:")
+        self.selected_part_label.pack()
+
+        self.selected_part_details = tk.Label(self.parts_frame)
+        self.selected_part_details.pack()
+
+        self.part_mileage_entry = tk.Entry(self.parts_frame)
+        self.part_mileage_entry.pack()
+
+        self.update_part_mileage_button = tk.Button(self.parts_frame, text="Update Part Mileage", command=self.update_part_mileage)
+        self.update_part_mileage_button.pack()
+
+        self.add_part_to_kart_button = tk.Button(self.parts_frame, text="Add Part to Kart", command=self.add_part_to_kart)
+        self.add_part_to_kart_button.pack()
+
+        self.remove_part_from_kart_button = tk.Button(self.parts_frame, text="Remove Part from Kart", command=self.remove_part_from_kart)
+        self.remove_part_from_kart_button.pack()
+
+        self.part_name_label = tk.Label(self.parts_frame, text="Part Name:")
+        self.part_name_label.pack()
+
+        self.part_name_entry = tk.Entry(self.parts_frame)
+        self.part_name_entry.pack()
+
+        self.part_details_label = tk.Label(self.parts_frame, text="Part Details:")
+        self.part_details_label.pack()
+
+        self.part_details_entry = tk.Text(self.parts_frame, height=4, width=30)
+        self.part_details_entry.pack()
+
+        self.add_part_button = tk.Button(self.parts_frame, text="Add Part", command=self.add_part)
+        self.add_part_button.pack()
+
+        self.remove_part_button = tk.Button(self.parts_frame, text="Remove Part", command=self.remove_part)
+        self.remove_part_button.pack()
+
+        self.parts_listbox.bind("<<ListboxSelect>>", self.on_part_selected)  # Bind selection event
+
+
+        self.refresh_parts()
+
+    def init_track_ui(self):
+        
+        self.track_label = tk.Label(self.track_frame, text="Track Database:")
+        self.track_label.pack()
+
+        self.track_listbox = tk.Listbox(self.track_frame,width=30)
+        self.track_listbox.pack()
+        self.track_view = ListView(self.track_listbox, self.format_track)
+
+        self.selected_track_label = tk.Label(self.track_frame, text="Selected Track:")
+        self.selected_track_label.pack()
+
+
+        self.track_name_label = tk.Label(self.track_frame, text="Track Name:")
+        self.track_name_label.pack()
+
+        self.track_name_entry = tk.Entry(self.track_frame)
+        self.track_name_entry.pack()
+
+        self.track_length_label = tk.Label(self.track_frame, text="Track Length:")
+        self.track_length_label.pack()
+
+        self.track_length_entry = tk.Entry(self.track_frame)
+        self.track_length_entry.pack()
+
+        self.add_track_button = tk.Button(self.track_frame, text="Add Track", command=self.add_track)
+        self.add_track_button.pack()
+
+        self.remove_track_button = tk.Button(self.track_frame, text="Remove Track", command=self.remove_track)
+        self.remove_track_button.pack()
+
+        self.track_laps_entry = tk.Entry(self.track_frame)
+        self.track_laps_entry.pack()
+
+        self.remove_track_button = tk.Button(self.track_frame, text="Add laps to kart", command=self.update_kart_mileage)
+        self.remove_track_button.pack()
+
+        self.track_listbox.bind("<<ListboxSelect>>", self.on_track_selected)  # Bind selection event
+
+        self.refresh_tracks()
+
+    def init_service_ui(self):
+        self.service_label = tk.Label(self.service_frame, text="Due for Service:")
+        self.service_label.pack()
+
+        self.service_listbox = tk.Listbox(self.service_frame, width=40, height=10)
+        self.service_listbox.pack()
+
+        self.service_alert_label = tk.Label(self.service_frame, text="")
+        self.service_alert_label.pack()
+
+        self.service_interval_label = tk.Label(self.service_frame, text="Service Interval:")
+        self.service_interval_label.pack()
+
+        self.service_interval_entry = tk.Entry(self.service_frame)
+        self.service_interval_entry.pack()
+
+        self.set_part_interval_button = tk.Button(self.service_frame, text="Set Interval for Part", command=self.set_part_interval)
+        self.set_part_interval_button.pack()
+
+        self.set_name_interval_button = tk.Button(self.service_frame, text="Set Interval for All Parts Named", command=self.set_name_interval)
+        self.set_name_interval_button.pack()
+
+        self.refresh_service()
+
+    def init_summary_ui(self):
+        self.summary_label = tk.Label(self.summary_frame, text="Fleet Summary:")
+        self.summary_label.pack()
+
+        self.summary_totals_label = tk.Label(self.summary_frame, text="")
+        self.summary_totals_label.pack()
+
+        self.summary_listbox = tk.Listbox(self.summary_frame, width=50, height=8)
+        self.summary_listbox.pack()
+
+        self.refresh_summary()
+
+    @timed_handler
+    def refresh_summary(self):
+        # Served from the database's running totals, not a pass over the parts
+        summary = self.database.fleet_summary()
+        text = f"Parts: {summary['parts']}  Unattached: {summary['unattached_parts']}"
+        if self.selected_kart in summary['karts']:
+            text += f"  Selected kart incl. parts: {summary['karts'][self.selected_kart]['total_mileage']:g}"
+        self.summary_totals_label.config(text=text)
+        self.summary_listbox.delete(0, tk.END)
+        for name, totals in sorted(summary['part_types'].items()):
+            self.summary_listbox.insert(tk.END, f"{name} x{totals['parts']} - Average Mileage: {totals['average_mileage']:.1f}")
+        for track_id, totals in (summary['tracks'] or {}).items():
+            self.summary_listbox.insert(tk.END, f"{self.database.tracks[track_id]['name']} - Driven: {totals['mileage']:g} ({totals['laps']} laps)")
+
+    def init_undo_ui(self):
+        self.undo_button = tk.Button(self.kart_frame, text="Undo", command=self.undo)
+        self.undo_button.pack()
+
+        self.redo_button = tk.Button(self.kart_frame, text="Redo", command=self.redo)
+        self.redo_button.pack()
+
+        self.root.bind("<Control-z>", lambda event: self.undo())
+        self.root.bind("<Control-y>", lambda event: self.redo())
+        self.refresh_undo()
+
+    def refresh_undo(self):
+        undo_label = self.database.undo_label()
+        redo_label = self.database.redo_label()
+        self.undo_button.config(text=f"Undo {undo_label}" if undo_label else "Undo",
+                                state=tk.NORMAL if undo_label else tk.DISABLED)
+        self.redo_button.config(text=f"Redo {redo_label}" if redo_label else "Redo",
+                                state=tk.NORMAL if redo_label else tk.DISABLED)
+
+    @timed_handler
+    def undo(self):
+        # The database reports the restored rows like any other change
+        self.database.undo()
+        self.refresh_undo()
+
+    @timed_handler
+    def redo(self):
+        self.database.redo()
+        self.refresh_undo()
+
+    def format_kart(self, kart_id):
+        kart_data = self.database.karts[kart_id]
+        return f"{kart_data['name']} - Mileage: {kart_data['mileage']}"
+
+    def format_track(self, track_id):
+        track_data = self.database.tracks[track_id]
+        return f"{track_data['name']} - Length: {track_data['mileage']}"
+
+    def format_part(self, part_id):
+        part = self.database.get_part(part_id)
+        return f"{part['name']} - Mileage: {part['mileage']}"
+
+    @timed_handler
+    def refresh_karts(self):
+        self.kart_view.set(self.database.karts)
+
+    @timed_handler
+    def refresh_tracks(self):
+        self.track_view.set(self.database.tracks)
+
+    @timed_handler
+    def refresh_kart_parts(self, kart_id):
+        if kart_id in self.database.karts:
+            self.kart_parts_view.set(part['id'] for part in self.database.get_kart_parts(kart_id))
+
+            # Display selected kart's name
+            selected_kart_name = self.database.karts[kart_id]['name']
+            self.selected_kart_label.config(text=f"Selected Kart: {selected_kart_name}")
+        else:
+            self.kart_parts_view.set([])
+            self.selected_kart_label.config(text="Selected Kart:")
+
+    @timed_handler
+    def refresh_parts(self):
+        if self.search_query:
+            self.run_search()
+            return
+        self.parts_view.set(part['id'] for part in self.database.parts)
+        self.search_page_label.config(text="")
+
+    def on_search_typed(self, event):
+        # Waits for a pause in typing before searching
+        if self.search_job is not None:
+            self.root.after_cancel(self.search_job)
+        self.search_job = self.root.after(SEARCH_DELAY, self.start_search)
+
+    def start_search(self):
+        self.search_job = None
+        query = self.search_entry.get().strip()
+        if query != self.search_query:
+            self.search_query = query
+            self.search_page = 0
+        self.refresh_parts()
+
+    @timed_handler
+    def run_search(self):
+        parts, more = self.database.search_parts(self.search_query, self.search_page * SEARCH_PAGE_SIZE, SEARCH_PAGE_SIZE)
+        if not parts and self.search_page > 0:
+            self.search_page -= 1  # the last page emptied out
+            return self.run_search()
+        self.search_more = more
+        self.parts_view.set(part['id'] for part in parts)
+        self.search_page_label.config(text=f"Page {self.search_page + 1}" + (" (more)" if more else ""))
+
+    def next_search_page(self):
+        if self.search_query and self.search_more:
+            self.search_page += 1
+            self.run_search()
+
+    def previous_search_page(self):
+        if self.search_query and self.search_page > 0:
+            self.search_page -= 1
+            self.run_search()
+
+    @timed_handler
+    def refresh_service(self):
+        # Only the head of the schedule is shown, so this stays cheap to
+        # call after every change
+        self.service_listbox.delete(0, tk.END)
+        for remaining, part in self.database.next_due(10):
+            self.service_listbox.insert(tk.END, f"{part['name']} (#{part['id']}) - Left: {remaining:g}")
+        alerts = self.database.take_alerts()
+        if alerts:
+            names = ', '.join(f"{self.database.get_part(part_id)['name']} (#{part_id})" for part_id, remaining in alerts)
+            self.service_alert_label.config(text=f"Service due: {names}")
+
+    @timed_handler
+    def on_database_changed(self, changes):
+        # Only the rows named in changes are touched
+        self.refresh_service()
+        self.refresh_summary()
+        self.refresh_undo()
+        if changes is None:
+            self.refresh_karts()
+            self.refresh_tracks()
+            self.refresh_parts()
+            self.refresh_kart_parts(self.selected_kart)
+            return
+        for op, row in changes:
+            if op == 'add_mileage':
+                for part in row['parts']:
+                    self.part_changed('put', part['id'])
+            elif row['type'] == 'part':
+                self.part_changed(op, str(row['id']))
+            elif row['type'] == 'kart':
+                self.kart_changed(op, str(row['id']))
+            elif row['type'] == 'track':
+                if op == 'del':
+                    self.track_view.remove(str(row['id']))
+                else:
+                    self.track_view.upsert(str(row['id']))
+
+    def part_changed(self, op, part_id):
+        part = self.database.get_part(part_id)
+        if op == 'del' or part is None:
+            self.parts_view.remove(part_id)
+            self.kart_parts_view.remove(part_id)
+            return
+        if not self.search_query or part_id in self.parts_view.positions:
+            self.parts_view.upsert(part_id)
+        elif self.database.part_matches(part_id, self.search_query):
+            self.on_search_typed(None)  # a new match; search again for its page
+        if self.selected_kart is not None and part['kart_id'] == str(self.selected_kart):
+            self.kart_parts_view.upsert(part_id)
+        else:
+            self.kart_parts_view.remove(part_id)
+
+    def kart_changed(self, op, kart_id):
+        if op == 'del' or kart_id not in self.database.karts:
+            self.kart_view.remove(kart_id)
+            if kart_id == self.selected_kart:
+                self.kart_parts_view.set([])
+            return
+        self.kart_view.upsert(kart_id)
+
+    @timed_handler
+    def add_kart(self):
+        kart_name = self.kart_name_entry.get()
+        if kart_name:
+            self.database.add_kart(kart_name)
+            self.kart_name_entry.delete(0, tk.END)
+
+    @timed_handler
+    def add_track(self):
+        track_name = self.track_name_entry.get()
+        length = self.track_length_entry.get()
+        if track_name:
+            self.database.add_track(track_name,length)
+            self.track_name_entry.delete(0, tk.END)
+            self.track_length_entry.delete(0, tk.END)
+
+    @timed_handler
+    def remove_kart(self):
+        selected_kart = self.kart_listbox.curselection()
+        if selected_kart:
+            kart_id = self.kart_view.key_at(selected_kart[0])
+            self.database.remove_kart(kart_id)
+
+    @timed_handler
+    def remove_track(self):
+        selected_track = self.track_listbox.curselection()
+        if selected_track:
+            track_id = self.track_view.key_at(selected_track[0])
+            self.database.remove_track(track_id)
+
+    @timed_handler
+    def add_part_to_kart(self):
+        if self.selected_part and self.selected_kart:
+            part_id = self.selected_part['id']
+            self.database.add_part_to_kart(self.selected_kart, part_id)  # Use selected kart
+
+    @timed_handler
+    def remove_part_from_kart(self):
+        if self.selected_part and self.selected_kart:
+            part_id = self.selected_part['id']
+            self.database.remove_part_from_kart(self.selected_kart, part_id)
+
+    @timed_handler
+    def add_part(self):
+        part_name = self.part_name_entry.get()
+        part_details = self.part_details_entry.get("1.0", tk.END).strip()
+        if part_details=='':
+            part_details="None"
+        if part_name:
+            self.database.add_part(part_name, part_details)
+            self.part_name_entry.delete(0, tk.END)
+            self.part_details_entry.delete("1.0", tk.END)
+
+
+    @timed_handler
+    def remove_part(self):
+        selected_part = self.parts_listbox.curselection()
+        if selected_part:
+            part_id = self.parts_view.key_at(selected_part[0])
+            self.database.remove_part(part_id)
+
+    @timed_handler
+    def update_kart_mileage(self):
+        manual = 0
+        auto = 0
+        
+        
+        if self.kart_mileage_entry.get() != '':
+            manual = int(self.kart_mileage_entry.get())
+        if self.track_laps_entry.get() != '':
+            laps = int(self.track_laps_entry.get())
+            auto = laps*float(self.database.tracks[self.selected_track]['mileage'])
+            
+        
+
+        if auto > 0:
+            mileage = auto
+        else:
+            mileage = manual
+
+        if mileage >= 0:
+            kart_id = self.selected_kart
+            if auto > 0:
+                self.database.apply_sessions([(kart_id, self.selected_track, laps)])  # Keeps the track in the history
+            else:
+                self.database.update_kart_mileage(kart_id, mileage)
+            self.kart_mileage_entry.delete(0, tk.END)
+            self.track_laps_entry.delete(0, tk.END)
+        else:
+            messagebox.showerror("Error", "Invalid kart selection or mileage value.")
+
+    @timed_handler
+    def update_part_mileage(self):
+        mileage = int(self.part_mileage_entry.get())
+        
+        if mileage >= 0:
+            part_id = self.selected_part['id']
+            print(mileage,part_id)
+            self.database.update_part_mileage(part_id, mileage)
+            self.part_mileage_entry.delete(0, tk.END)
+        else:
+            messagebox.showerror("Error", "Invalid kart selection or mileage value.")
+
+    def read_service_interval(self):
+        # An empty entry clears the interval
+        value = self.service_interval_entry.get().strip()
+        if value == '':
+            return None
+        return float(value)
+
+    @timed_handler
+    def set_part_interval(self):
+        if not self.selected_part:
+            return
+        try:
+            limit = self.read_service_interval()
+        except ValueError:
+            messagebox.showerror("Error", "Invalid service interval.")
+            return
+        self.database.set_service_interval(limit, part_id=self.selected_part['id'])
+        self.service_interval_entry.delete(0, tk.END)
+
+    @timed_handler
+    def set_name_interval(self):
+        if not self.selected_part:
+            return
+        try:
+            limit = self.read_service_interval()
+        except ValueError:
+            messagebox.showerror("Error", "Invalid service interval.")
+            return
+        self.database.set_service_interval(limit, part_name=self.selected_part['name'])
+        self.service_interval_entry.delete(0, tk.END)
@@ -0,0 +1,253 @@
+import csv
+import json
+import math
+import os
+import time
+from array import array
+from bisect import bisect_left
+
+HISTORY_FIELDS = ['time', 'type', 'id', 'kart_id', 'track_id', 'laps', 'delta', 'mileage']
+ROLLUP_SECONDS = 3600
+INDEX_VERSION = 1
+
+class MileageHistory:
+    # Append-only log of mileage changes, one event per kart or part per
+    # change: (time, type, id, kart_id, track_id, laps, delta, mileage after).
+    #
+    # The events stay in the file. In memory there are only per record and
+    # per hour sums of the deltas and laps plus the mileage after the hour's
+    # last event (rollups, as typed columns), and where each hour starts in
+    # the file, so a lookup reads at most an hour or two of events back.
+    # That state is saved to <history>.index every index_every events, and
+    # loading only parses the events written after it.
+    def __init__(self, filename, index_every=4096):
+        self.filename = filename
+        self.index_filename = filename + '.index'
+        self.index_every = index_every
+        self.pending = []
+        self.reset()
+        self.load()
+
+    def reset(self):
+        self.before = {}  # (type, id) -> mileage before its first event
+        self.rollups = {}  # (type, id) -> (hours, mileage, laps, mileage after), hours ascending
+        self.hours = array('q')  # hours with events, ascending...
+        self.offsets = array('q')  # ...and the file offset of each one's first event
+        self.size = 0  # bytes of the file read so far
+        self.inode = None
+        self.last_time = -math.inf  # times are kept ascending, see add()
+        self.unsaved = 0  # events read since the index was saved
+
+    def load(self):
+        try:
+            with open(self.index_filename) as file:
+                index = json.load(file)
+        except (FileNotFoundError, ValueError):
+            index = None
+        try:
+            stat = os.stat(self.filename)
+        except FileNotFoundError:
+            return
+        # The index only counts while the file is the same one, not shorter
+        if (index and index['version'] == INDEX_VERSION and index['inode'] == stat.st_ino
+                and index['size'] <= stat.st_size):
+            self.size = index['size']
+            self.inode = index['inode']
+            self.last_time = index['last_time']
+            self.hours = array('q', index['hours'])
+            self.offsets = array('q', index['offsets'])
+            for type, id, mileage in index['before']:
+                self.before[(type, id)] = mileage
+            for type, id, hours, mileage, laps, after in index['rollups']:
+                self.rollups[(type, id)] = (array('q', hours), array('d', mileage), array('q', laps), array('d', after))
+        self.refresh()
+        if self.unsaved:
+            self.save_index()
+
+    def refresh(self):
+        # Reads whatever was appended since we last looked, by us (from the
+        # writer thread) or by another instance sharing the file
+        try:
+            file = open(self.filename, 'rb')
+        except FileNotFoundError:
+            return
+        with file:
+            inode = os.fstat(file.fileno()).st_ino
+            if inode != self.inode:
+                if self.inode is not None:
+                    self.reset()  # the file was replaced; start over
+                self.inode = inode
+            file.seek(self.size)
+            data = file.read()
+        data = data[:data.rfind(b'\n') + 1]  # a line still being written is left for next time
+        offset = self.size
+        for line in data.splitlines(keepends=True):
+            event = parse_event(line)
+            if event is not None:
+                self.add(event, offset)
+            offset += len(line)
+        self.size = offset
+        if self.unsaved >= self.index_every:
+            self.save_index()
+
+    def save_index(self):
+        index = {
+            'version': INDEX_VERSION,
+            'size': self.size,
+            'inode': self.inode,
+            'last_time': self.last_time,
+            'hours': self.hours.tolist(),
+            'offsets': self.offsets.tolist(),
+            'before': [[type, id, mileage] for (type, id), mileage in self.before.items()],
+            'rollups': [[type, id] + [column.tolist() for column in rollup] for (type, id), rollup in self.rollups.items()],
+        }
+        temp_filename = self.index_filename + '.tmp'
+        with open(temp_filename, 'w') as file:
+            json.dump(index, file)
+        os.replace(temp_filename, self.index_filename)
+        self.unsaved = 0
+
+    def record(self, type, id, kart_id, delta, mileage, track_id='', laps=0, when=None):
+        # Held until take(), so a rolled back batch leaves no events behind
+        if when is None:
+            when = time.time()
+        self.pending.append((when, type, str(id), str(kart_id), str(track_id), laps, delta, mileage))
+
+    def discard(self):
+        self.pending = []
+
+    def take(self):
+        # Returns the pending events for write(), which can run on another
+        # thread; they become queryable once written and read back
+        events, self.pending = self.pending, []
+        return events
+
+    def write(self, events):
+        if not events:
+            return
+        with open(self.filename, 'a', newline='') as file:
+            writer = csv.writer(file)
+            if file.tell() == 0:
+                writer.writerow(HISTORY_FIELDS)
+            writer.writerows(events)
+
+    def flush(self):
+        self.write(self.take())
+
+    def add(self, event, offset):
+        when = max(event[0], self.last_time)  # the clock went back; keep times ascending
+        self.last_time = when
+        type, id, track_id, laps, delta, mileage = event[1], event[2], event[4], event[5], event[6], event[7]
+        hour = int(when // ROLLUP_SECONDS)
+        if not self.hours or self.hours[-1] != hour:
+            self.hours.append(hour)
+            self.offsets.append(offset)
+        key = (type, id)
+        self.before.setdefault(key, mileage - delta)
+        self.roll_up(key, hour, delta, laps, mileage)
+        if type == 'kart' and track_id:
+            self.roll_up(('track', track_id), hour, delta, laps, 0.0)
+        self.unsaved += 1
+
+    def roll_up(self, key, hour, delta, laps, mileage):
+        rollup = self.rollups.get(key)
+        if rollup is None:
+            rollup = self.rollups[key] = (array('q'), array('d'), array('q'), array('d'))
+        hours, deltas, hour_laps, after = rollup
+        if hours and hours[-1] == hour:
+            deltas[-1] += delta
+            hour_laps[-1] += laps
+            after[-1] = mileage
+        else:
+            hours.append(hour)
+            deltas.append(delta)
+            hour_laps.append(laps)
+            after.append(mileage)
+
+    def events(self, start, end):
+        # Events from start (inclusive) to end (exclusive), read from the
+        # file starting at the first hour with events from start on
+        index = bisect_left(self.hours, int(start // ROLLUP_SECONDS))
+        if index >= len(self.offsets) or start >= end:
+            return
+        with open(self.filename, 'rb') as file:
+            position = self.offsets[index]
+            file.seek(position)
+            last_time = -math.inf
+            for line in file:
+                position += len(line)
+                if position > self.size:
+                    return  # not read by refresh() yet
+                event = parse_event(line)
+                if event is None:
+                    continue
+                last_time = max(event[0], last_time)  # the same ordering as add()
+                if last_time >= end:
+                    return
+                if last_time >= start:
+                    yield (last_time,) + event[1:]
+
+    def mileage_at(self, type, id, when):
+        # Mileage of a kart or part at a time, or None if it has no history
+        self.refresh()
+        key = (type, str(id))
+        if key not in self.before:
+            return None
+        hours, deltas, laps, after = self.rollups[key]
+        hour = int(when // ROLLUP_SECONDS)
+        index = bisect_left(hours, hour)
+        if index < len(hours) and hours[index] == hour:
+            # Partway through an hour with events; find the last one so far
+            mileage = None
+            for event in self.events(hour * ROLLUP_SECONDS, math.nextafter(when, math.inf)):
+                if event[1] == type and event[2] == key[1]:
+                    mileage = event[7]
+            if mileage is not None:
+                return mileage
+        return after[index - 1] if index else self.before[key]
+
+    def totals(self, type, id, start, end):
+        # {'mileage', 'laps'} added to a kart, part or track between start
+        # (inclusive) and end (exclusive). Whole hours come from the rollups,
+        # only the partial hours at either end are read event by event.
+        self.refresh()
+        key = (type, str(id))
+        mileage = 0.0
+        laps = 0
+        first = math.ceil(start / ROLLUP_SECONDS)
+        last = math.floor(end / ROLLUP_SECONDS)
+        if first < last:
+            if key in self.rollups:
+                hours, deltas, hour_laps, after = self.rollups[key]
+                begin, stop = bisect_left(hours, first), bisect_left(hours, last)
+                mileage = sum(deltas[begin:stop])
+                laps = sum(hour_laps[begin:stop])
+            edges = [(start, first * ROLLUP_SECONDS), (last * ROLLUP_SECONDS, end)]
+        else:
+            edges = [(start, end)]
+        for edge_start, edge_end in edges:
+            for event in self.events(edge_start, edge_end):
+                if self.matches(event, type, key[1]):
+                    mileage += event[6]
+                    laps += event[5]
+        return {'mileage': mileage, 'laps': laps}
+
+    def between(self, start, end, type=None, id=None):
+        # The events themselves, e.g. a kart's sessions over a weekend
+        self.refresh()
+        for event in self.events(start, end):
+            if type is None or self.matches(event, type, str(id)):
+                yield dict(zip(HISTORY_FIELDS, event))
+
+    def matches(self, event, type, id):
+        if type == 'track':
+            return event[1] == 'kart' and event[4] == id
+        return event[1] == type and event[2] == id
+
+def parse_event(line):
+    # One line of the file as an event tuple, or None for the header
+    values = next(csv.reader([line.decode('utf-8')]), None)
+    if not values or values[0] == 'time':
+        return None
+    when, type, id, kart_id, track_id, laps, delta, mileage = values
+    return (float(when), type, id, kart_id, track_id, int(laps), float(delta), float(mileage))
@@ -0,0 +1,141 @@
+import cProfile
+import functools
+import io
+import json
+import logging
+import pstats
+import threading
+import time
+import tracemalloc
+from collections import deque
+
+log = logging.getLogger('car_parts')
+
+class OperationStats:
+    # Call counts, latency histograms (power-of-two microsecond buckets)
+    # and bytes written per operation. Bytes are credited to every
+    # operation running on the writing thread, so save_data and the
+    # update_kart_mileage that triggered it both see them.
+    def __init__(self, slow_threshold=None, time_gui=False, slow_log_size=200):
+        self.slow_threshold = slow_threshold  # seconds; None turns the slow log off
+        self.time_gui = time_gui
+        self.operations = {}
+        self.slow = deque(maxlen=slow_log_size)
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.profiler = None
+        self.capture = {}
+
+    def active(self):
+        stack = getattr(self.local, 'stack', None)
+        if stack is None:
+            stack = self.local.stack = []
+        return stack
+
+    def entry(self, name):
+        entry = self.operations.get(name)
+        if entry is None:
+            entry = self.operations[name] = {'calls': 0, 'total': 0.0, 'max': 0.0, 'bytes': 0, 'histogram': {}}
+        return entry
+
+    def record(self, name, elapsed, outermost=True):
+        bucket = int(elapsed * 1e6).bit_length()
+        with self.lock:
+            entry = self.entry(name)
+            entry['calls'] += 1
+            entry['total'] += elapsed
+            entry['max'] = max(entry['max'], elapsed)
+            entry['histogram'][bucket] = entry['histogram'].get(bucket, 0) + 1
+        # Only the outermost operation is logged, not every call under it
+        if outermost and self.slow_threshold is not None and elapsed >= self.slow_threshold:
+            self.slow.append({'operation': name, 'seconds': elapsed, 'at': time.time()})
+            log.warning("slow operation %s took %.1f ms", name, elapsed * 1000)
+
+    def add_bytes(self, count):
+        with self.lock:
+            for name in self.active():
+                self.entry(name)['bytes'] += count
+
+    def start_capture(self, profile=True, memory=False):
+        # cProfile only sees the thread that starts it (the GUI thread)
+        if profile and self.profiler is None:
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        if memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def stop_capture(self, profile_filename=None, top=20):
+        if self.profiler is not None:
+            self.profiler.disable()
+            if profile_filename:
+                self.profiler.dump_stats(profile_filename)
+            output = io.StringIO()
+            pstats.Stats(self.profiler, stream=output).sort_stats('cumulative').print_stats(top)
+            self.capture['profile'] = output.getvalue()
+            self.profiler = None
+        if tracemalloc.is_tracing():
+            current, peak = tracemalloc.get_traced_memory()
+            snapshot = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+            self.capture['memory'] = {
+                'current': current,
+                'peak': peak,
+                'top': [str(stat) for stat in snapshot.statistics('lineno')[:top]],
+            }
+        return self.capture
+
+    def summary(self):
+        with self.lock:
+            operations = {}
+            for name, entry in self.operations.items():
+                operations[name] = dict(
+                    entry,
+                    mean=entry['total'] / entry['calls'] if entry['calls'] else 0.0,
+                    histogram={f"<{1 << bucket}us": count for bucket, count in sorted(entry['histogram'].items())},
+                )
+        return {'operations': operations, 'slow': list(self.slow), 'capture': self.capture}
+
+    def dump(self, filename):
+        with open(filename, 'w') as file:
+            json.dump(self.summary(), file, indent=2)
+
+    def reset(self):
+        with self.lock:
+            self.operations = {}
+            self.slow.clear()
+            self.capture = {}
+
+def instrumented(method):
+    name = method.__name__
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        stats = self.stats
+        stack = stats.active()
+        stack.append(name)
+        started = time.perf_counter()
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            stats.record(name, time.perf_counter() - started, len(stack) == 1)
+            stack.pop()
+    return wrapper
+
+def timed_handler(method):
+    # For CarPartGUI event handlers; only measured when time_gui is on
+    name = 'gui.' + method.__name__
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        stats = self.database.stats
+        if not stats.time_gui:
+            return method(self, *args, **kwargs)
+        stack = stats.active()
+        stack.append(name)
+        started = time.perf_counter()
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            stats.record(name, time.perf_counter() - started, len(stack) == 1)
+            stack.pop()
+    return wrapper
@@ -0,0 +1,251 @@
+import argparse
+import asyncio
+import os
+import queue
+import random
+import sys
+import tempfile
+import termios
+import threading
+import time
+import tty
+
+# Lap events arrive one per line from the lap counter:
+#
+#     LAP <kart_id> <track_id> <laps>
+#
+# Blank lines and lines starting with '#' are ignored.
+
+class LapIngestor:
+    def __init__(self, database, flush_interval=0.25):
+        self.database = database
+        self.flush_interval = flush_interval
+        self.pending = {}  # (kart_id, track_id) -> [laps, events] since the last flush
+        self.pending_events = 0
+        self.oldest = None  # receive time of the oldest pending event
+        self.ready = queue.Queue()  # batches waiting for drain() on the GUI thread
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        self.counters = {
+            'lines': 0,
+            'events': 0,
+            'bad_lines': 0,
+            'dropped_events': 0,
+            'batches': 0,
+            'applied_events': 0,
+            'last_lag': 0.0,
+            'max_lag': 0.0,
+            'write_errors': 0,
+        }
+
+    def feed(self, line):
+        self.counters['lines'] += 1
+        fields = line.split()
+        if not fields or fields[0].startswith('#'):
+            return
+        try:
+            command, kart_id, track_id, laps = fields
+            laps = int(laps)
+        except ValueError:
+            self.counters['bad_lines'] += 1
+            return
+        if command != 'LAP' or laps < 0:
+            self.counters['bad_lines'] += 1
+            return
+        with self.lock:
+            key = (kart_id, track_id)
+            totals = self.pending.get(key)
+            if totals is None:
+                self.pending[key] = [laps, 1]
+            else:
+                totals[0] += laps
+                totals[1] += 1
+            self.pending_events += 1
+            if self.oldest is None:
+                self.oldest = time.monotonic()
+        self.counters['events'] += 1
+
+    def take(self):
+        with self.lock:
+            if not self.pending:
+                return None
+            batch = ([(kart_id, track_id, laps) for (kart_id, track_id), (laps, events) in self.pending.items()],
+                     [events for laps, events in self.pending.values()], self.pending_events, self.oldest)
+            self.pending = {}
+            self.pending_events = 0
+            self.oldest = None
+        return batch
+
+    def apply(self, batch):
+        entries, counts, events, oldest = batch
+        tracks = self.database.tracks
+        known = []
+        dropped = 0
+        for entry, count in zip(entries, counts):
+            if entry[1] in tracks and entry[0] in self.database.karts:
+                known.append(entry)
+            else:
+                dropped += count  # every lap line that went into the entry
+        self.counters['dropped_events'] += dropped
+        if known:
+            self.database.apply_sessions(known, undoable=False)  # not the user's to undo
+        lag = time.monotonic() - oldest
+        self.counters['batches'] += 1
+        self.counters['applied_events'] += events - dropped
+        self.counters['last_lag'] = lag
+        self.counters['max_lag'] = max(self.counters['max_lag'], lag)
+
+    def apply_and_report(self, batch):
+        self.apply(batch)
+        self.report_write_errors()
+
+    def report_write_errors(self, writer=None):
+        # Without the GUI, which shows them, the background writer's errors
+        # are counted and printed here
+        writer = writer or self.database.writer
+        if writer is None:
+            return
+        while True:
+            try:
+                error = writer.errors.get_nowait()
+            except queue.Empty:
+                return
+            self.counters['write_errors'] += 1
+            print(f"could not save laps: {type(error).__name__}: {error}", file=sys.stderr)
+
+    def drain(self):
+        # Called from the thread that owns the database (the Tk mainloop)
+        while True:
+            try:
+                batch = self.ready.get_nowait()
+            except queue.Empty:
+                return
+            self.apply(batch)
+
+    def stats(self):
+        elapsed = time.monotonic() - self.started
+        stats = dict(self.counters)
+        stats['events_per_second'] = self.counters['events'] / elapsed if elapsed else 0.0
+        stats['pending_events'] = self.pending_events
+        return stats
+
+    async def read_lines(self, reader):
+        while True:
+            line = await reader.readline()
+            if not line:
+                return
+            self.feed(line.decode('ascii', 'replace'))
+
+    async def flush_loop(self, handoff):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            batch = self.take()
+            if batch:
+                handoff(batch)
+
+    async def run(self, port, baudrate=9600, handoff=None):
+        # handoff defaults to applying on this loop's thread; the GUI passes
+        # self.ready.put and drains from the mainloop instead
+        reader = await open_port(port, baudrate)
+        flusher = asyncio.ensure_future(self.flush_loop(handoff or self.apply))
+        try:
+            await self.read_lines(reader)
+        finally:
+            flusher.cancel()
+            batch = self.take()
+            if batch:
+                (handoff or self.apply)(batch)
+
+    def start(self, port, baudrate=9600):
+        thread = threading.Thread(target=asyncio.run, args=(self.run(port, baudrate, self.ready.put),),
+                                  name='lap-ingest', daemon=True)
+        thread.start()
+        return thread
+
+async def open_port(port, baudrate=9600):
+    fd = os.open(port, os.O_RDONLY | os.O_NOCTTY | os.O_NONBLOCK)
+    if os.isatty(fd):
+        tty.setraw(fd, termios.TCSANOW)
+        attrs = termios.tcgetattr(fd)
+        attrs[4] = attrs[5] = getattr(termios, f'B{baudrate}')
+        termios.tcsetattr(fd, termios.TCSANOW, attrs)
+    reader = asyncio.StreamReader()
+    loop = asyncio.get_running_loop()
+    await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), os.fdopen(fd, 'rb', buffering=0))
+    return reader
+
+def open_simulated_port():
+    # A pseudo-terminal standing in for the lap counter: write lap lines to
+    # the returned fd and point the ingestor at the returned path
+    master, slave = os.openpty()
+    tty.setraw(slave)
+    return master, os.ttyname(slave)
+
+async def emit_laps(fd, kart_ids, track_ids, events, rate=1000.0):
+    # Paced against the clock rather than sleeping per event, so high rates
+    # are not capped by the loop's sleep resolution
+    os.set_blocking(fd, False)
+    started = time.monotonic()
+    for number in range(events):
+        line = f"LAP {random.choice(kart_ids)} {random.choice(track_ids)} {random.randint(1, 3)}\n".encode('ascii')
+        while True:
+            try:
+                os.write(fd, line)
+                break
+            except BlockingIOError:  # the reader is behind and the pty buffer is full
+                await asyncio.sleep(0.001)
+        delay = started + (number + 1) / rate - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+async def simulate(database, events, rate):
+    master, port = open_simulated_port()
+    ingestor = LapIngestor(database)
+    reading = asyncio.ensure_future(ingestor.run(port))
+    await emit_laps(master, list(database.karts), list(database.tracks), events, rate)
+    while ingestor.counters['events'] < events:
+        await asyncio.sleep(0.01)
+    await asyncio.sleep(ingestor.flush_interval * 2)
+    reading.cancel()
+    os.close(master)
+    return ingestor
+
+def main(argv=None):
+    from app import CarPartDatabase
+
+    parser = argparse.ArgumentParser(description="Feed laps from the lap counter into the parts database.")
+    parser.add_argument('port', nargs='?', help="serial device of the lap counter")
+    parser.add_argument('--database', default='car_parts.csv')
+    parser.add_argument('--baudrate', type=int, default=9600)
+    parser.add_argument('--simulate', type=int, metavar='EVENTS',
+                        help="run a simulated lap counter over a pseudo-terminal against a scratch database")
+    parser.add_argument('--karts', type=int, default=20)
+    parser.add_argument('--rate', type=float, default=2000.0, help="simulated events per second")
+    args = parser.parse_args(argv)
+
+    if args.simulate:
+        with tempfile.TemporaryDirectory() as directory:
+            database = CarPartDatabase(os.path.join(directory, 'car_parts.csv'), journal=True)
+            with database.batch():
+                database.add_track('Simulated', 1.2)
+                for number in range(args.karts):
+                    database.add_kart(f"Kart {number + 1}")
+            ingestor = asyncio.run(simulate(database, args.simulate, args.rate))
+            print(ingestor.stats())
+        return
+    if not args.port:
+        parser.error("a port is required unless --simulate is given")
+    database = CarPartDatabase(args.database, journal=True, background=True, history=True)
+    ingestor = LapIngestor(database)
+    try:
+        asyncio.run(ingestor.run(args.port, args.baudrate, ingestor.apply_and_report))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        writer = database.writer
+        database.close()
+        ingestor.report_write_errors(writer)  # the last writes finish on close
+        print(ingestor.stats(), file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,191 @@
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+from bench import generate_fleet
+
+class ApiClient:
+    # One keep-alive HTTP/1.1 connection, one request at a time
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.reader = self.writer = None
+
+    async def connect(self):
+        # Change events for a kart's sessions list all its parts on one line
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port, limit=1 << 24)
+
+    async def request(self, method, path, body=None):
+        data = json.dumps(body).encode() if body is not None else b''
+        self.writer.write(f"{method} {path} HTTP/1.1\r\nHost: {self.host}\r\n"
+                          f"Content-Type: application/json\r\nContent-Length: {len(data)}\r\n\r\n".encode() + data)
+        status = int((await self.reader.readline()).split()[1])
+        length = 0
+        while True:
+            line = await self.reader.readline()
+            if line in (b'\r\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            if name.lower() == 'content-length':
+                length = int(value)
+        return status, json.loads(await self.reader.readexactly(length))
+
+    async def events(self, path='/events'):
+        # Yields each server-sent event as a dict
+        self.writer.write(f"GET {path} HTTP/1.1\r\nHost: {self.host}\r\n\r\n".encode())
+        while (await self.reader.readline()) not in (b'\r\n', b''):
+            pass
+        while True:
+            line = await self.reader.readline()
+            if not line:
+                return
+            if line.startswith(b'data: '):
+                yield json.loads(line[6:])
+
+    def close(self):
+        if self.writer:
+            self.writer.close()
+
+def serve(filename, storage, flush_interval, connection):
+    # Runs in its own process so the clients do not share its event loop
+    from app import CarPartDatabase
+    from server import ApiServer
+
+    if storage == 'sqlite':
+        database = CarPartDatabase(filename, backend='sqlite', background=True)
+    else:
+        database = CarPartDatabase(filename, journal=True, background=True)
+    server = ApiServer(database, flush_interval=flush_interval)
+    try:
+        asyncio.run(server.serve('127.0.0.1', 0, connection.send))
+    finally:
+        database.close()
+
+async def run_client(client, rng, requests, kart_ids, part_ids, track_ids, latencies, statuses):
+    for _ in range(requests):
+        roll = rng.random()
+        if roll < 0.5:
+            kind, method, path, body = 'get_part', 'GET', f"/parts/{rng.choice(part_ids)}", None
+        elif roll < 0.7:
+            kind, method, path, body = 'part_mileage', 'POST', f"/parts/{rng.choice(part_ids)}/mileage", {'mileage': 1.5}
+        elif roll < 0.85:
+            kind, method, path = 'sessions', 'POST', '/sessions'
+            body = {'sessions': [[rng.choice(kart_ids), rng.choice(track_ids), rng.randint(1, 20)]]}
+        else:
+            # Read-modify-write with the version just read; conflicts with
+            # other clients show up as 409s
+            part_id = rng.choice(part_ids)
+            status, found = await client.request('GET', f"/parts/{part_id}")
+            kind, method, path = 'attach', 'POST', f"/karts/{rng.choice(kart_ids)}/parts"
+            body = {'part_id': part_id, 'version': found['version']}
+        started = time.perf_counter()
+        status, payload = await client.request(method, path, body)
+        latencies.setdefault(kind, []).append(time.perf_counter() - started)
+        statuses[status] = statuses.get(status, 0) + 1
+
+async def watch(client, received):
+    async for event in client.events():
+        received['events'] += 1
+        received['changes'] += len(event.get('changes', ()))
+
+def summarize(times):
+    times = sorted(times)
+    quantile = lambda q: times[min(len(times) - 1, int(q * len(times)))] * 1000
+    return {'count': len(times), 'mean_ms': statistics.mean(times) * 1000,
+            'p50_ms': quantile(0.5), 'p95_ms': quantile(0.95), 'p99_ms': quantile(0.99), 'max_ms': times[-1] * 1000}
+
+async def load(port, clients, requests, subscribers, karts, parts, tracks, seed):
+    kart_ids = [str(id) for id in range(1, karts + 1)]
+    part_ids = [str(id) for id in range(1, parts + 1)]
+    track_ids = [str(id) for id in range(1, tracks + 1)]
+    latencies = {}
+    statuses = {}
+    received = {'events': 0, 'changes': 0}
+    watchers = []
+    for _ in range(subscribers):
+        client = ApiClient('127.0.0.1', port)
+        await client.connect()
+        watchers.append((client, asyncio.ensure_future(watch(client, received))))
+    connections = []
+    for number in range(clients):
+        client = ApiClient('127.0.0.1', port)
+        await client.connect()
+        connections.append(client)
+    started = time.perf_counter()
+    await asyncio.gather(*(run_client(client, random.Random(seed + number), requests, kart_ids, part_ids,
+                                      track_ids, latencies, statuses)
+                           for number, client in enumerate(connections)))
+    elapsed = time.perf_counter() - started
+    status, server_stats = await connections[0].request('GET', '/stats')
+    await asyncio.sleep(0.2)  # let the last events reach the subscribers
+    for client, task in watchers:
+        task.cancel()
+        client.close()
+    for client in connections:
+        client.close()
+    total = sum(len(times) for times in latencies.values())
+    return {
+        'requests': total,
+        'seconds': elapsed,
+        'requests_per_second': total / elapsed,
+        'latency': {'all': summarize([t for times in latencies.values() for t in times]),
+                    **{kind: summarize(times) for kind, times in sorted(latencies.items())}},
+        'statuses': statuses,
+        'subscribers': dict(received, per_subscriber=received['events'] / subscribers if subscribers else 0),
+        'server': server_stats['server'],
+    }
+
+def run(clients, requests, subscribers=2, karts=50, parts=10000, tracks=10, storage='journal',
+        flush_interval=0.002, seed=0):
+    with tempfile.TemporaryDirectory() as directory:
+        filename = os.path.join(directory, 'car_parts.csv')
+        generate_fleet(filename, parts, karts, tracks, seed)
+        if storage == 'sqlite':
+            from app import CarPartDatabase
+            csv_filename, filename = filename, os.path.join(directory, 'car_parts.db')
+            CarPartDatabase(filename, backend='sqlite').import_csv(csv_filename)
+        receiver, sender = multiprocessing.Pipe(duplex=False)
+        process = multiprocessing.Process(target=serve, args=(filename, storage, flush_interval, sender), daemon=True)
+        process.start()
+        try:
+            port = receiver.recv()
+            results = asyncio.run(load(port, clients, requests, subscribers, karts, parts, tracks, seed))
+        finally:
+            process.terminate()
+            process.join()
+    results['config'] = {'clients': clients, 'requests_per_client': requests, 'subscribers': subscribers,
+                         'karts': karts, 'parts': parts, 'tracks': tracks, 'storage': storage,
+                         'flush_interval': flush_interval, 'python': sys.version.split()[0]}
+    return results
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load test server.py with simulated pit-lane clients.")
+    parser.add_argument('--clients', default='1,10,50', help="comma separated client counts")
+    parser.add_argument('--requests', type=int, default=200, help="requests per client")
+    parser.add_argument('--subscribers', type=int, default=2, help="clients listening on /events")
+    parser.add_argument('--parts', type=int, default=10000)
+    parser.add_argument('--karts', type=int, default=50)
+    parser.add_argument('--storage', choices=['journal', 'sqlite'], default='journal')
+    parser.add_argument('--flush-interval', type=float, default=0.002)
+    parser.add_argument('--output', help="write the results as JSON to this file instead of stdout")
+    args = parser.parse_args(argv)
+
+    runs = [run(int(clients), args.requests, args.subscribers, args.karts, args.parts, storage=args.storage,
+                flush_interval=args.flush_interval)
+            for clients in args.clients.split(',')]
+    report = json.dumps(runs, indent=2)
+    if args.output:
+        with open(args.output, 'w') as file:
+            file.write(report + '\n')
+    else:
+        print(report)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,485 @@
+import argparse
+import asyncio
+import json
+import queue
+import re
+import sys
+import time
+from itertools import islice
+from urllib.parse import parse_qs, unquote
+
+from app import FIELDNAMES, CarPartDatabase
+
+# A JSON API over one CarPartDatabase, so several pit-lane tablets can log
+# laps at once. Every request is handled on one event loop thread, which is
+# the only thread touching the database.
+#
+# Each kart, part and track has a version, bumped on every change to it.
+# Reads return it; a write may send the version it last saw and gets 409
+# Conflict if the record has changed since. Writes arriving together are
+# run in one database.batch(), so they are persisted in a single pass.
+# GET /events is a server-sent event stream of the changed records.
+
+REASONS = {200: 'OK', 201: 'Created', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+           409: 'Conflict', 500: 'Internal Server Error'}
+
+class ApiError(Exception):
+    def __init__(self, status, message, **details):
+        super().__init__(message)
+        self.status = status
+        self.payload = dict(details, error=message)
+
+class ApiServer:
+    def __init__(self, database, flush_interval=0.002, event_queue_size=1000):
+        self.database = database
+        self.flush_interval = flush_interval  # how long a write waits for others to share its batch
+        self.event_queue_size = event_queue_size
+        self.versions = {}  # (type, id) -> version; kept after a delete so stale writers still conflict
+        self.writes = []  # (operation, future) for the next batch
+        self.changed = set()  # records changed so far by the running batch
+        self.pending_values = {}  # database.pending entries as of the last note_changes()
+        self.wakeup = None
+        self.saving = None  # report_when_saved, while it waits for the writer
+        self.subscribers = set()
+        self.counters = {'requests': 0, 'writes': 0, 'batches': 0, 'conflicts': 0, 'errors': 0, 'events': 0,
+                         'write_errors': 0, 'batch_seconds': 0.0}
+        self.routes = [
+            ('GET', r'/karts', self.list_karts),
+            ('POST', r'/karts', self.add_kart),
+            ('GET', r'/karts/([^/]+)', self.get_kart),
+            ('DELETE', r'/karts/([^/]+)', self.remove_kart),
+            ('POST', r'/karts/([^/]+)/mileage', self.add_kart_mileage),
+            ('GET', r'/karts/([^/]+)/parts', self.list_kart_parts),
+            ('POST', r'/karts/([^/]+)/parts', self.attach_part),
+            ('DELETE', r'/karts/([^/]+)/parts/([^/]+)', self.detach_part),
+            ('GET', r'/parts', self.list_parts),
+            ('POST', r'/parts', self.add_part),
+            ('GET', r'/parts/([^/]+)', self.get_part),
+            ('DELETE', r'/parts/([^/]+)', self.remove_part),
+            ('POST', r'/parts/([^/]+)/mileage', self.add_part_mileage),
+            ('GET', r'/tracks', self.list_tracks),
+            ('POST', r'/tracks', self.add_track),
+            ('DELETE', r'/tracks/([^/]+)', self.remove_track),
+            ('POST', r'/sessions', self.add_sessions),
+            ('GET', r'/due', self.due),
+            ('GET', r'/summary', self.summary),
+            ('GET', r'/stats', self.stats),
+        ]
+        self.routes = [(method, re.compile(pattern + '$'), handler) for method, pattern, handler in self.routes]
+        database.subscribe(self.on_database_changed)
+
+    # Versions and change events
+
+    def version(self, type, id):
+        return self.versions.get((type, str(id)), 0)
+
+    def check_version(self, type, id, body):
+        # A record already changed by this batch is one version ahead of
+        # what has been published, even though it has not been bumped yet
+        expected = body.get('version')
+        current = self.version(type, id) + ((type, str(id)) in self.changed)
+        if expected is not None and expected != current:
+            self.counters['conflicts'] += 1
+            raise ApiError(409, f"{type} {id} has changed", current=self.record(type, id))
+
+    def record(self, type, id):
+        id = str(id)
+        if type == 'kart':
+            row = self.database.kart_row(id) if id in self.database.karts else None
+        elif type == 'track':
+            row = self.database.track_row(id) if id in self.database.tracks else None
+        else:
+            part = self.database.get_part(id)
+            row = dict(part) if part is not None else None
+        if row is None:
+            return None
+        return {'record': {field: row.get(field, '') for field in FIELDNAMES}, 'version': self.version(type, id)}
+
+    def on_database_changed(self, changes):
+        if changes is None:
+            self.publish({'reload': True})
+            return
+        publishing = bool(self.subscribers)
+        touched = {}
+        for op, row in changes:
+            if op == 'add_mileage':
+                for part in row['parts']:
+                    touched[('part', str(part['id']))] = 'put'
+            else:
+                touched[(row['type'], str(row['id']))] = 'put' if op == 'add' else op
+        records = []
+        for (type, id), op in touched.items():
+            if type == 'interval':
+                continue
+            self.versions[(type, id)] = self.versions.get((type, id), 0) + 1
+            if not publishing:
+                continue
+            current = self.record(type, id) if op == 'put' else None
+            records.append({'op': op, 'type': type, 'id': id, 'version': self.versions[(type, id)],
+                            'record': current['record'] if current else None})
+        if records:
+            self.publish({'changes': records})
+
+    def publish(self, event):
+        self.counters['events'] += 1
+        message = ('data: ' + json.dumps(event) + '\n\n').encode()
+        for queue in list(self.subscribers):
+            try:
+                queue.put_nowait(message)
+            except asyncio.QueueFull:
+                self.subscribers.discard(queue)  # too far behind; it is told to reload
+                queue.get_nowait()
+                queue.put_nowait(None)
+
+    # Writes
+
+    async def submit(self, operation):
+        future = asyncio.get_running_loop().create_future()
+        self.writes.append((operation, future))
+        self.wakeup.set()
+        return await future
+
+    async def write_loop(self):
+        while True:
+            await self.wakeup.wait()
+            if self.flush_interval:
+                await asyncio.sleep(self.flush_interval)
+            self.wakeup.clear()
+            writes, self.writes = self.writes, []
+            started = time.perf_counter()
+            self.run_batch(writes)
+            self.counters['batch_seconds'] += time.perf_counter() - started
+            if self.database.writer and (self.saving is None or self.saving.done()):
+                self.saving = asyncio.ensure_future(self.report_when_saved())
+
+    async def report_when_saved(self):
+        await asyncio.get_running_loop().run_in_executor(None, self.database.flush)
+        self.report_write_errors()
+
+    def report_write_errors(self, writer=None):
+        # Writes are answered before the background writer has them on disk
+        # (waiting for it halves throughput), so a failed write can only be
+        # counted and logged; it shows up in /stats as write_errors.
+        # report_when_saved runs this once the writer catches up.
+        writer = writer or self.database.writer
+        while writer is not None:
+            try:
+                error = writer.errors.get_nowait()
+            except queue.Empty:
+                return
+            self.counters['write_errors'] += 1
+            print(f"could not save: {type(error).__name__}: {error}", file=sys.stderr)
+
+    def run_batch(self, writes):
+        # Operations check everything before they change anything, so one
+        # failing leaves the rest of the batch to go ahead. The batch is not
+        # atomic: an atomic one copies the whole database to be able to undo.
+        results = []
+        try:
+            with self.database.batch(atomic=False):
+                for operation, future in writes:
+                    try:
+                        results.append(operation())
+                    except ApiError as error:
+                        results.append(error)
+                    except Exception as error:
+                        self.counters['errors'] += 1
+                        results.append(ApiError(500, f"{type(error).__name__}: {error}"))
+                    self.note_changes()
+        except Exception as error:
+            self.counters['errors'] += 1
+            results = [ApiError(500, f"{type(error).__name__}: {error}")] * len(writes)
+        self.changed = set()
+        self.pending_values = {}
+        self.counters['batches'] += 1
+        self.counters['writes'] += len(writes)
+        for (operation, future), result in zip(writes, results):
+            if future.cancelled():
+                continue
+            if isinstance(result, ApiError):
+                future.set_exception(result)
+            else:
+                future.set_result(self.created(result))
+
+    def note_changes(self):
+        # Every commit stores a new entry at the end of database.pending
+        # (moving the key there if it was already pending), so what the last
+        # operation touched is the run of entries at the end that were not
+        # there, as the same object, last time
+        pending = self.database.pending
+        for key, value in reversed(pending.items()):
+            if self.pending_values.get(key) is value:
+                break
+            self.pending_values[key] = value
+            op, row = value
+            if op == 'add_mileage':
+                self.changed.update(('part', str(part['id'])) for part in row['parts'])
+            else:
+                self.changed.add((row['type'], str(row['id'])))
+
+    def created(self, result):
+        # Operations return the (type, id) they changed; the version is only
+        # known once the batch has been committed
+        if isinstance(result, tuple):
+            type, id = result
+            return {'id': id, 'version': self.version(type, id)}
+        return result
+
+    def require(self, type, id):
+        found = self.record(type, id)
+        if found is None:
+            raise ApiError(404, f"no such {type}: {id}")
+        return found
+
+    # Handlers: (query, body, *path parameters) -> (status, payload)
+
+    async def list_karts(self, query, body):
+        return 200, {'karts': [self.record('kart', id) for id in self.database.karts]}
+
+    async def get_kart(self, query, body, kart_id):
+        return 200, self.require('kart', kart_id)
+
+    async def add_kart(self, query, body):
+        name = self.field(body, 'name', str)
+        return 201, await self.submit(lambda: ('kart', self.database.add_kart(name)))
+
+    async def remove_kart(self, query, body, kart_id):
+        def operation():
+            self.require('kart', kart_id)
+            self.check_version('kart', kart_id, body)
+            self.database.remove_kart(kart_id)
+            return ('kart', kart_id)
+        return 200, await self.submit(operation)
+
+    async def add_kart_mileage(self, query, body, kart_id):
+        mileage = self.field(body, 'mileage', (int, float))
+        def operation():
+            self.require('kart', kart_id)
+            self.check_version('kart', kart_id, body)
+            self.database.update_kart_mileage(kart_id, mileage)
+            return ('kart', kart_id)
+        return 200, await self.submit(operation)
+
+    async def list_kart_parts(self, query, body, kart_id):
+        self.require('kart', kart_id)
+        return 200, {'parts': [self.record('part', part.id) for part in self.database.get_kart_parts(kart_id)]}
+
+    async def attach_part(self, query, body, kart_id):
+        part_id = str(self.field(body, 'part_id', (str, int)))
+        def operation():
+            self.require('kart', kart_id)
+            self.require('part', part_id)
+            self.check_version('part', part_id, body)
+            self.database.add_part_to_kart(kart_id, part_id)
+            return ('part', part_id)
+        return 200, await self.submit(operation)
+
+    async def detach_part(self, query, body, kart_id, part_id):
+        def operation():
+            self.require('part', part_id)
+            self.check_version('part', part_id, body)
+            self.database.remove_part_from_kart(kart_id, part_id)
+            return ('part', part_id)
+        return 200, await self.submit(operation)
+
+    async def list_parts(self, query, body):
+        offset = int(query.get('offset', ['0'])[0])
+        limit = min(int(query.get('limit', ['100'])[0]), 1000)
+        search = query.get('search', [''])[0]
+        if search:
+            parts, more = self.database.search_parts(search, offset, limit)
+        else:
+            parts = list(islice(self.database.parts, offset, offset + limit))
+            more = offset + limit < len(self.database.parts)
+        return 200, {'parts': [self.record('part', part.id) for part in parts], 'more': more}
+
+    async def get_part(self, query, body, part_id):
+        return 200, self.require('part', part_id)
+
+    async def add_part(self, query, body):
+        name = self.field(body, 'name', str)
+        details = body.get('details') or 'None'
+        return 201, await self.submit(lambda: ('part', self.database.add_part(name, details)))
+
+    async def remove_part(self, query, body, part_id):
+        def operation():
+            self.require('part', part_id)
+            self.check_version('part', part_id, body)
+            self.database.remove_part(part_id)
+            return ('part', part_id)
+        return 200, await self.submit(operation)
+
+    async def add_part_mileage(self, query, body, part_id):
+        mileage = self.field(body, 'mileage', (int, float))
+        def operation():
+            self.require('part', part_id)
+            self.check_version('part', part_id, body)
+            self.database.update_part_mileage(part_id, mileage)
+            return ('part', part_id)
+        return 200, await self.submit(operation)
+
+    async def list_tracks(self, query, body):
+        return 200, {'tracks': [self.record('track', id) for id in self.database.tracks]}
+
+    async def add_track(self, query, body):
+        name = self.field(body, 'name', str)
+        length = self.field(body, 'length', (int, float))
+        return 201, await self.submit(lambda: ('track', self.database.add_track(name, length)))
+
+    async def remove_track(self, query, body, track_id):
+        def operation():
+            self.require('track', track_id)
+            self.check_version('track', track_id, body)
+            self.database.remove_track(track_id)
+            return ('track', track_id)
+        return 200, await self.submit(operation)
+
+    async def add_sessions(self, query, body):
+        # {"sessions": [[kart_id, track_id, laps], ...]}; sessions for unknown
+        # karts or tracks are skipped and counted
+        try:
+            entries = [(str(kart_id), str(track_id), int(laps)) for kart_id, track_id, laps in body['sessions']]
+        except (KeyError, TypeError, ValueError):
+            raise ApiError(400, "sessions must be a list of [kart_id, track_id, laps]")
+        def operation():
+            known = [entry for entry in entries if entry[0] in self.database.karts and entry[1] in self.database.tracks]
+            totals = self.database.apply_sessions(known)
+            return {'applied': len(known), 'skipped': len(entries) - len(known), 'mileage': totals}
+        return 200, await self.submit(operation)
+
+    async def due(self, query, body):
+        count = int(query.get('count', ['10'])[0])
+        return 200, {'due': [dict(self.record('part', part.id), remaining=remaining)
+                             for remaining, part in self.database.next_due(count)]}
+
+    async def summary(self, query, body):
+        return 200, self.database.fleet_summary()
+
+    async def stats(self, query, body):
+        counters = dict(self.counters, subscribers=len(self.subscribers))
+        counters['writes_per_batch'] = counters['writes'] / counters['batches'] if counters['batches'] else 0.0
+        return 200, {'server': counters, 'database': self.database.stats.summary()['operations']}
+
+    def field(self, body, name, types):
+        value = body.get(name)
+        if not isinstance(value, types) or isinstance(value, bool):
+            raise ApiError(400, f"missing or invalid field: {name}")
+        return value
+
+    # HTTP
+
+    async def dispatch(self, method, path, query, body):
+        allowed = False
+        for route_method, pattern, handler in self.routes:
+            match = pattern.match(path)
+            if match:
+                if route_method != method:
+                    allowed = True
+                    continue
+                return await handler(query, body, *map(unquote, match.groups()))
+        if allowed:
+            raise ApiError(405, f"{method} not allowed on {path}")
+        raise ApiError(404, f"no such resource: {path}")
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, target, version = request_line.decode('latin-1').split()
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                data = await reader.readexactly(int(headers.get('content-length', 0)))
+                path, _, query = target.partition('?')
+                if method == 'GET' and path == '/events':
+                    await self.stream_events(writer)
+                    break
+                self.counters['requests'] += 1
+                try:
+                    body = json.loads(data) if data else {}
+                    if not isinstance(body, dict):
+                        raise ApiError(400, "the body must be a JSON object")
+                    status, payload = await self.dispatch(method, path, parse_qs(query), body)
+                except ApiError as error:
+                    status, payload = error.status, error.payload
+                except (ValueError, KeyError) as error:
+                    status, payload = 400, {'error': str(error)}
+                except Exception as error:
+                    self.counters['errors'] += 1
+                    status, payload = 500, {'error': f"{type(error).__name__}: {error}"}
+                closing = headers.get('connection', '').lower() == 'close' or version == 'HTTP/1.0'
+                self.respond(writer, status, payload, closing)
+                await writer.drain()
+                if closing:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    def respond(self, writer, status, payload, closing=False):
+        data = json.dumps(payload).encode()
+        writer.write(f"HTTP/1.1 {status} {REASONS[status]}\r\n"
+                     f"Content-Type: application/json\r\n"
+                     f"Content-Length: {len(data)}\r\n"
+                     f"Connection: {'close' if closing else 'keep-alive'}\r\n\r\n".encode('latin-1') + data)
+
+    async def stream_events(self, writer):
+        queue = asyncio.Queue(self.event_queue_size)
+        self.subscribers.add(queue)
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nCache-Control: no-cache\r\n\r\n")
+        try:
+            while True:
+                message = await queue.get()
+                if message is None:
+                    writer.write(('data: ' + json.dumps({'reload': True}) + '\n\n').encode())
+                    await writer.drain()
+                    return
+                writer.write(message)
+                await writer.drain()
+        finally:
+            self.subscribers.discard(queue)
+
+    async def serve(self, host='127.0.0.1', port=8080, ready=None):
+        self.wakeup = asyncio.Event()
+        writing = asyncio.ensure_future(self.write_loop())
+        server = await asyncio.start_server(self.handle, host, port)
+        if ready:
+            ready(server.sockets[0].getsockname()[1])
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            writing.cancel()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve a parts database as a JSON API.")
+    parser.add_argument('--database', default='car_parts.csv')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    args = parser.parse_args(argv)
+
+    if args.database.endswith(('.db', '.sqlite')):
+        database = CarPartDatabase(args.database, backend='sqlite', background=True, history=True)
+    else:
+        database = CarPartDatabase(args.database, journal=True, background=True, snapshot=True, history=True)
+    server = ApiServer(database)
+    try:
+        asyncio.run(server.serve(args.host, args.port,
+                                 lambda port: print(f"serving {args.database} on http://{args.host}:{port}", file=sys.stderr)))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        writer = database.writer
+        database.close()
+        server.report_write_errors(writer)  # the last writes finish on close
+        print(json.dumps(server.counters), file=sys.stderr)
+
+if __name__ == "__main__":
+    main()